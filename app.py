@@ -7,20 +7,2618 @@ interactive charts based on Location and Grade selection.
 Installation:
     pip install flask pandas openpyxl --break-system-packages
 
+Optional faster Excel reader (picked up by EXCEL_READER=auto):
+    pip install python-calamine --break-system-packages
+
+Optional brotli compression of large responses (gzip is always available):
+    pip install brotli --break-system-packages
+
+Optional multi-process production server (used by `python app.py` when installed):
+    pip install gunicorn --break-system-packages
+
 Usage:
-    python resin_chart_app.py
+    python app.py           # production server: WORKERS processes x THREADS threads
+    python app.py --dev     # Flask development server with the debugger
     
 Then open: http://localhost:5000
+
+Datasets listed in PRELOAD_DATASETS (comma-separated workbook paths or
+stored dataset ids) are parsed once before the workers fork, so every
+worker shares the same matrices copy-on-write.
+
+Parsed datasets are kept once per host in DATASET_STORE_DIR and every
+worker memory-maps them from there; point it at /dev/shm to keep the
+store in RAM. Chunked upload sessions live in UPLOAD_DIR and request
+metrics in METRICS_DIR, so any worker can serve any request.
 """
 
-from flask import Flask, render_template_string, request, jsonify
+from flask import Flask, Response, render_template_string, request, jsonify, g, has_request_context, make_response
+from werkzeug.exceptions import HTTPException
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from urllib.parse import urlencode
+import multiprocessing
+import argparse
+import gc
+import openpyxl
+import numpy as np
 import pandas as pd
+import hashlib
+import threading
+import time
+import uuid
+import tempfile
+import shutil
 import json
+import gzip
 import io
 import os
 
+try:
+    import fcntl
+except ImportError:
+    # Windows: chunk appends are not locked across processes
+    fcntl = None
+
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['DATASET_CACHE_MAX_BYTES'] = int(os.environ.get('DATASET_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+app.config['INGEST_WORKERS'] = int(os.environ.get('INGEST_WORKERS', 2))
+app.config['SHEET_WORKERS'] = int(os.environ.get('SHEET_WORKERS', min(4, os.cpu_count() or 1)))
+# Sheet worker processes are stopped after this long without a multi-sheet parse
+app.config['SHEET_WORKERS_IDLE_SECONDS'] = int(os.environ.get('SHEET_WORKERS_IDLE_SECONDS', 300))
+app.config['JOB_RETENTION_SECONDS'] = int(os.environ.get('JOB_RETENTION_SECONDS', 600))
+app.config['UPLOAD_DIR'] = os.environ.get('UPLOAD_DIR', os.path.join(tempfile.gettempdir(), 'resin-uploads'))
+# Each chunk is one request body, so it can be no larger than MAX_CONTENT_LENGTH
+app.config['UPLOAD_CHUNK_BYTES'] = min(int(os.environ.get('UPLOAD_CHUNK_BYTES', 8 * 1024 * 1024)),
+                                       app.config['MAX_CONTENT_LENGTH'])
+app.config['MAX_UPLOAD_BYTES'] = int(os.environ.get('MAX_UPLOAD_BYTES', 512 * 1024 * 1024))
+app.config['UPLOAD_SESSION_SECONDS'] = int(os.environ.get('UPLOAD_SESSION_SECONDS', 24 * 3600))
+app.config['EXCEL_READER'] = os.environ.get('EXCEL_READER', 'auto')
+app.config['MAX_BATCH_SERIES'] = int(os.environ.get('MAX_BATCH_SERIES', 1000))
+app.config['MAX_ROLLING_WINDOW'] = int(os.environ.get('MAX_ROLLING_WINDOW', 36))
+# Rolling metric matrices cached per dataset, least recently used dropped first
+app.config['ROLLING_CACHE_MAX_BYTES'] = int(os.environ.get('ROLLING_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+app.config['MAX_CORRELATION_SERIES'] = int(os.environ.get('MAX_CORRELATION_SERIES', 100))
+app.config['DATASET_STORE_DIR'] = os.environ.get('DATASET_STORE_DIR', os.path.join(tempfile.gettempdir(), 'resin-datasets'))
+app.config['DATASET_STORE_MAX_BYTES'] = int(os.environ.get('DATASET_STORE_MAX_BYTES', 4 * 1024 * 1024 * 1024))
+# A parse claim not refreshed for this long is presumed abandoned and taken over
+app.config['PARSE_CLAIM_TIMEOUT_SECONDS'] = int(os.environ.get('PARSE_CLAIM_TIMEOUT_SECONDS', 600))
+app.config['HOST'] = os.environ.get('HOST', '0.0.0.0')
+app.config['PORT'] = int(os.environ.get('PORT', 5000))
+app.config['WORKERS'] = int(os.environ.get('WORKERS', os.cpu_count() or 1))
+app.config['THREADS'] = int(os.environ.get('THREADS', 4))
+app.config['WORKER_TIMEOUT'] = int(os.environ.get('WORKER_TIMEOUT', 120))
+app.config['SERIES_MAX_AGE'] = int(os.environ.get('SERIES_MAX_AGE', 24 * 3600))
+app.config['COMPRESS_MIN_BYTES'] = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+app.config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', 6))
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'resin-metrics'))
+app.config['METRICS_FLUSH_SECONDS'] = float(os.environ.get('METRICS_FLUSH_SECONDS', 5))
+app.config['PRELOAD_DATASETS'] = [item.strip() for item in os.environ.get('PRELOAD_DATASETS', '').split(',') if item.strip()]
+
+REQUIRED_COLS = ['Country', 'Location', 'Grade']
+META_COLS = ['Country', 'Location', 'Grade', 'Unit']
+# Added to the metadata of workbooks with several data sheets
+SHEET_COL = 'Sheet'
+
+# Resample frequencies accepted by the freq parameter, as pandas rules
+RESAMPLE_RULES = {'W': 'W', 'M': 'MS', 'Q': 'QS', 'Y': 'YS'}
+
+# Rolling analytics that can be overlaid on a series
+ROLLING_METRICS = ('ma', 'volatility_pct', 'mom_pct', 'yoy_pct')
+# Rolling metrics that depend on the window length; the rest are fixed lags
+WINDOWED_METRICS = ('ma', 'volatility_pct')
+# Correlation results cached per dataset
+CORRELATION_CACHE_SIZE = 32
+# Scratch space for finding each pair's last shared date, a block of rows at a time
+CORRELATION_BLOCK_BYTES = 16 * 1024 * 1024
+
+# Part of every series ETag; bump it when the series response changes shape
+SERIES_ETAG_VERSION = '1'
+# Series response formats, negotiated through the Accept header. The raw
+# format is a JSON header followed by little-endian typed buffers; Arrow IPC
+# needs pyarrow. Binary dates are int64 days since 1970-01-01.
+JSON_MIMETYPE = 'application/json'
+RAW_SERIES_MIMETYPE = 'application/x-resin-series'
+ARROW_MIMETYPE = 'application/vnd.apache.arrow.stream'
+RAW_SERIES_MAGIC = b'RSN1'
+SERIES_DTYPES = ('float64', 'float32')
+
+# Responses the compression hook may encode
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/html', 'text/plain')
+
+# Histogram buckets (seconds) for request and stage timings on /metrics
+TIMING_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class IngestError(Exception):
+    """Raised when an uploaded file cannot be turned into a dataset."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class Metrics:
+    """Counters and timing histograms, rendered in the Prometheus text format.
+
+    Each process counts in memory. Once share() is called, every process
+    also writes a snapshot to a common directory and render() adds up all
+    of them, so a scrape that reaches any worker covers them all.
+    """
+
+    def __init__(self, buckets=TIMING_BUCKETS):
+        self.buckets = buckets
+        self._counters = defaultdict(float)
+        self._histograms = {}
+        self._help = {}
+        self._lock = threading.Lock()
+        self.directory = None
+        self._snapshot_path = None
+        self._flusher_pid = None
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, amount=1, **labels):
+        with self._lock:
+            self._counters[name, tuple(sorted(labels.items()))] += amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = histogram[0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    counts[i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def share(self, directory):
+        """Aggregate with every process forked from here through snapshot files in directory.
+
+        Call before forking. What this process has counted so far is written
+        out once and then cleared, so forked workers do not report it again.
+        Snapshots of exited workers are kept, keeping counters monotonic.
+        """
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._snapshot_path = os.path.join(directory, f'{os.getpid()}-{uuid.uuid4().hex[:8]}.json')
+        self.flush()
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def start_flushing(self):
+        """Start writing this process's snapshot every METRICS_FLUSH_SECONDS, once per process."""
+        if self.directory is None or self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+            self._snapshot_path = os.path.join(self.directory, f'{os.getpid()}-{uuid.uuid4().hex[:8]}.json')
+
+        def flush_forever():
+            while True:
+                time.sleep(app.config['METRICS_FLUSH_SECONDS'])
+                self.flush()
+
+        threading.Thread(target=flush_forever, name='metrics-flush', daemon=True).start()
+
+    def _snapshot(self):
+        with self._lock:
+            counters = [[name, labels, value] for (name, labels), value in self._counters.items()]
+            histograms = [[name, labels, list(h[0]), h[1], h[2]] for (name, labels), h in self._histograms.items()]
+        return {'counters': counters, 'histograms': histograms}
+
+    def flush(self):
+        """Write this process's counters and histograms for the other processes to read."""
+        if self._snapshot_path is None:
+            return
+        tmp_path = f'{self._snapshot_path}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self._snapshot(), f)
+            os.replace(tmp_path, self._snapshot_path)
+        except OSError as e:
+            app.logger.warning('Could not write metrics snapshot: %s', e)
+
+    def _collect(self):
+        """Return (counters, histograms) of this process plus every other snapshot in the directory."""
+        snapshots = [self._snapshot()]
+        if self.directory is not None:
+            own = os.path.basename(self._snapshot_path or '')
+            for name in os.listdir(self.directory):
+                if name.endswith('.json') and name != own:
+                    try:
+                        with open(os.path.join(self.directory, name)) as f:
+                            snapshots.append(json.load(f))
+                    except (OSError, ValueError):
+                        continue
+        counters = defaultdict(float)
+        histograms = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot['counters']:
+                counters[name, tuple(tuple(pair) for pair in labels)] += value
+            for name, labels, counts, total, count in snapshot['histograms']:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                merged = histograms.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+                merged[0] = [a + b for a, b in zip(merged[0], counts)]
+                merged[1] += total
+                merged[2] += count
+        return counters, histograms
+
+    def render(self, gauges=()):
+        """Return every metric as exposition text; gauges are (name, labels, value) read at scrape time.
+
+        Gauges describe the process answering the scrape (the store gauges
+        cover the whole host); counters and histograms cover every process
+        sharing the snapshot directory.
+        """
+        lines = []
+        described = set()
+
+        def header(name):
+            if name not in described and name in self._help:
+                described.add(name)
+                kind, text = self._help[name]
+                lines.append(f'# HELP {name} {text}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        def number(value):
+            value = float(value)
+            return str(int(value)) if value.is_integer() else repr(value)
+
+        def label_text(labels):
+            if not labels:
+                return ''
+            pairs = []
+            for key, value in labels:
+                value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                pairs.append(f'{key}="{value}"')
+            return '{' + ','.join(pairs) + '}'
+
+        counters, histograms = self._collect()
+        counters = sorted(counters.items())
+        histograms = sorted((key, (h[0], h[1], h[2])) for key, h in histograms.items())
+        for (name, labels), value in counters:
+            header(name)
+            lines.append(f'{name}{label_text(labels)} {number(value)}')
+        for (name, labels), (counts, total, count) in histograms:
+            header(name)
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{name}_bucket{label_text(labels + (("le", f"{bound:g}"),))} {bucket_count}')
+            lines.append(f'{name}_bucket{label_text(labels + (("le", "+Inf"),))} {count}')
+            lines.append(f'{name}_sum{label_text(labels)} {total:.6f}')
+            lines.append(f'{name}_count{label_text(labels)} {count}')
+        for name, labels, value in gauges:
+            header(name)
+            lines.append(f'{name}{label_text(tuple(sorted(labels.items())))} {number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('resin_request_seconds', 'histogram', 'Request latency by endpoint and status.')
+metrics.describe('resin_stage_seconds', 'histogram', 'Time spent in each stage of a request or ingest job.')
+metrics.describe('resin_dataset_lookups_total', 'counter', 'Dataset lookups by where the dataset was found.')
+metrics.describe('resin_dataset_cache_bytes', 'gauge', 'Memory held or mapped by cached datasets.')
+metrics.describe('resin_dataset_cache_max_bytes', 'gauge', 'Memory budget of the dataset cache.')
+metrics.describe('resin_dataset_cache_items', 'gauge', 'Datasets held in the cache.')
+metrics.describe('resin_dataset_bytes', 'gauge', 'Memory held or mapped by each cached dataset.')
+metrics.describe('resin_store_bytes', 'gauge', 'Bytes held by the shared dataset store on this host.')
+metrics.describe('resin_store_max_bytes', 'gauge', 'Budget of the shared dataset store.')
+metrics.describe('resin_store_references', 'gauge', 'Live processes attached to each stored dataset.')
+metrics.describe('resin_ingest_jobs', 'gauge', 'Ingest jobs currently running.')
+metrics.describe('resin_not_modified_total', 'counter', 'Conditional requests answered with 304 Not Modified.')
+metrics.describe('resin_compressed_bytes_total', 'counter', 'Response bytes before and after compression by encoding.')
+metrics.describe('resin_parses_coalesced_total', 'counter', 'Ingest jobs that reused a parse finished by another worker.')
+
+
+@contextmanager
+def stage_timer(stage, endpoint=None):
+    """Time a block as one stage, for the Server-Timing header and /metrics.
+
+    Inside a request the stage is attributed to the request's endpoint and
+    reported back in Server-Timing; elsewhere (ingest jobs) pass endpoint.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if has_request_context():
+            endpoint = endpoint or request.endpoint
+            g.setdefault('stage_timings', []).append((stage, elapsed))
+        metrics.observe('resin_stage_seconds', elapsed, endpoint=endpoint or 'unknown', stage=stage)
+
+
+def compute_stats(values, dates):
+    """Compute summary statistics for every row of a value matrix in one pass.
+
+    NaN cells are ignored. Returns a DataFrame with one row per matrix row:
+    points, first, latest, peak, lowest, average, stddev, change_pct,
+    cagr_pct (annualised over the dates of the first and latest points,
+    NaN when they are less than a year apart) and max_drawdown_pct (largest fall from a running peak, <= 0).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if values.shape[1] == 0:
+        # A sheet without date columns behaves like one empty column
+        values = np.full((values.shape[0], 1), np.nan)
+        dates = np.array(['NaT'], dtype='datetime64[ns]')
+    n_rows, n_cols = values.shape
+    mask = ~np.isnan(values)
+    points = mask.sum(axis=1)
+    has_data = points > 0
+    rows = np.arange(n_rows)
+
+    # First and latest non-empty cell of each row
+    first_idx = np.argmax(mask, axis=1)
+    last_idx = n_cols - 1 - np.argmax(mask[:, ::-1], axis=1)
+    first = np.where(has_data, values[rows, first_idx], np.nan)
+    latest = np.where(has_data, values[rows, last_idx], np.nan)
+
+    # Masked reductions avoid nanmax/nanmean warnings on empty rows
+    filled = np.where(mask, values, 0.0)
+    safe_points = np.maximum(points, 1)
+    average = np.where(has_data, filled.sum(axis=1) / safe_points, np.nan)
+    peak = np.where(has_data, np.where(mask, values, -np.inf).max(axis=1, initial=-np.inf), np.nan)
+    lowest = np.where(has_data, np.where(mask, values, np.inf).min(axis=1, initial=np.inf), np.nan)
+    deviations = np.where(mask, values - average[:, None], 0.0)
+    stddev = np.where(has_data, np.sqrt((deviations ** 2).sum(axis=1) / safe_points), np.nan)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        change_pct = (latest - first) / first * 100
+
+        # Annualised growth between the dates of the first and latest points;
+        # compounding a span shorter than a year blows small moves up. A
+        # calendar year is 365 days outside leap years, hence the day count
+        span = (dates[last_idx] - dates[first_idx]).astype('timedelta64[D]').astype(np.float64)
+        span[np.isnat(dates[last_idx]) | np.isnat(dates[first_idx])] = np.nan
+        years = span / 365.25
+        valid = (span >= 365) & (first > 0) & (latest > 0)
+        cagr_pct = np.where(valid, ((latest / first) ** (1 / np.where(valid, years, 1)) - 1) * 100, np.nan)
+
+        # Forward-fill gaps, then measure each point against its running peak
+        fill_idx = np.maximum.accumulate(np.where(mask, np.arange(n_cols), 0), axis=1)
+        filled_forward = values[rows[:, None], fill_idx]
+        running_peak = np.fmax.accumulate(filled_forward, axis=1)
+        drawdown = filled_forward / running_peak - 1
+    drawdown = np.where(np.isnan(drawdown), np.inf, drawdown).min(axis=1, initial=np.inf)
+    max_drawdown_pct = np.where(has_data & np.isfinite(drawdown), drawdown * 100, np.nan)
+
+    return pd.DataFrame({
+        'points': points,
+        'first': first,
+        'latest': latest,
+        'peak': peak,
+        'lowest': lowest,
+        'average': average,
+        'stddev': stddev,
+        'change_pct': change_pct,
+        'cagr_pct': cagr_pct,
+        'max_drawdown_pct': max_drawdown_pct,
+    })
+
+
+def _lag_columns(dates, months):
+    """Return, for each date column, the column in the same month `months` earlier, or -1."""
+    lagged = np.full(len(dates), -1, dtype=np.intp)
+    valid = ~np.isnat(dates)
+    if not valid.any():
+        return lagged
+    axis = dates[valid]
+    periods = axis.astype('datetime64[M]')
+    targets = periods - np.timedelta64(months, 'M')
+    # Latest column on or before the end of the target month, kept if it falls in that month
+    candidates = np.searchsorted(periods, targets, side='right') - 1
+    found = (candidates >= 0) & (periods[np.maximum(candidates, 0)] == targets)
+    lagged[np.flatnonzero(valid)] = np.where(found, np.flatnonzero(valid)[np.maximum(candidates, 0)], -1)
+    return lagged
+
+
+def _rolling_moments(values, window):
+    """Return the rolling mean and population stddev over `window` columns of every row.
+
+    Windows are differences of cumulative sums, so the cost is independent of
+    the window length; a window with any NaN cell is NaN.
+    """
+    n_rows, n_cols = values.shape
+    mean = np.full((n_rows, n_cols), np.nan)
+    std = np.full((n_rows, n_cols), np.nan)
+    if n_cols < window:
+        return mean, std
+    mask = ~np.isnan(values)
+    filled = np.where(mask, values, 0.0)
+    zeros = np.zeros((n_rows, 1))
+    sums = np.concatenate([zeros, np.cumsum(filled, axis=1)], axis=1)
+    squares = np.concatenate([zeros, np.cumsum(filled ** 2, axis=1)], axis=1)
+    counts = np.concatenate([zeros, np.cumsum(mask, axis=1)], axis=1)
+
+    full = (counts[:, window:] - counts[:, :-window]) == window
+    window_mean = (sums[:, window:] - sums[:, :-window]) / window
+    variance = np.maximum((squares[:, window:] - squares[:, :-window]) / window - window_mean ** 2, 0.0)
+    mean[:, window - 1:] = np.where(full, window_mean, np.nan)
+    std[:, window - 1:] = np.where(full, np.sqrt(variance), np.nan)
+    return mean, std
+
+
+def compute_rolling(values, dates, window, names=ROLLING_METRICS):
+    """Compute the named rolling analytics for every row of a value matrix at once.
+
+    Returns a dict of matrices shaped like values, for those of these in names:
+    ma             moving average over the last `window` columns
+    volatility_pct standard deviation of the last `window` period returns,
+                   each measured from the previous non-empty point
+    mom_pct        change from the same row one month earlier
+    yoy_pct        change from the same row twelve months earlier
+    Windows need `window` non-empty cells; NaN cells stay NaN. Every metric is
+    a whole-matrix NumPy operation, with no per-row loop.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n_rows, n_cols = values.shape
+    mask = ~np.isnan(values)
+    rows = np.arange(n_rows)[:, None]
+
+    result = {}
+    if 'ma' in names:
+        result['ma'], _ = _rolling_moments(values, window)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if 'volatility_pct' in names:
+            # Returns between consecutive non-empty points of each row
+            last_seen = np.maximum.accumulate(np.where(mask, np.arange(n_cols), -1), axis=1)
+            previous = np.concatenate([np.full((n_rows, 1), -1), last_seen[:, :-1]], axis=1)
+            returns = np.where(mask & (previous >= 0), values / values[rows, np.maximum(previous, 0)] - 1, np.nan)
+            _, volatility = _rolling_moments(returns, window)
+            result['volatility_pct'] = volatility * 100
+
+        for name, months in (('mom_pct', 1), ('yoy_pct', 12)):
+            if name in names:
+                lagged = _lag_columns(dates, months)
+                base = np.where(lagged >= 0, values[:, np.maximum(lagged, 0)], np.nan)
+                result[name] = (values / base - 1) * 100
+
+    return result
+
+
+def compute_correlation(values, basis='returns'):
+    """Pairwise correlation and spreads between the rows of a value matrix.
+
+    Each pair uses only the columns where both rows have a value, and every
+    pairwise sum comes from one matrix product over the aligned date axis.
+    basis='returns' correlates period-over-period changes, 'levels' the
+    prices themselves. Returns a dict of n x n matrices: correlation,
+    observations (points the pair has in common), spread_mean and
+    spread_latest (row minus column price).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if values.shape[1] == 0:
+        values = np.full((values.shape[0], 1), np.nan)
+    if basis == 'returns':
+        data = np.full_like(values, np.nan)
+        data[:, 1:] = values[:, 1:] / values[:, :-1] - 1
+    else:
+        data = values
+
+    mask = (~np.isnan(data)).astype(np.float64)
+    # Centring each row first keeps the sums of squares well conditioned
+    with np.errstate(invalid='ignore'):
+        centred = np.where(mask > 0, data - np.nanmean(np.where(mask > 0, data, np.nan), axis=1, keepdims=True), 0.0)
+    centred = np.nan_to_num(centred)
+    counts = mask @ mask.T
+    sums = centred @ mask.T
+    squares = (centred ** 2) @ mask.T
+    products = centred @ centred.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = products - sums * sums.T / counts
+        variance = squares - sums ** 2 / counts
+        correlation = covariance / np.sqrt(variance * variance.T)
+    correlation[counts < 2] = np.nan
+    correlation = np.clip(correlation, -1.0, 1.0)
+
+    # Spreads are always between price levels, over the dates both rows share
+    present = ~np.isnan(values)
+    level_mask = present.astype(np.float64)
+    levels = np.where(present, values, 0.0)
+    level_counts = level_mask @ level_mask.T
+    level_sums = levels @ level_mask.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        spread_mean = (level_sums - level_sums.T) / level_counts
+    # The last date each pair shares, found a block of rows at a time so the
+    # rows x rows x dates overlap never has to exist all at once
+    n_rows, n_cols = present.shape
+    last = np.empty((n_rows, n_rows), dtype=np.intp)
+    block = max(1, CORRELATION_BLOCK_BYTES // max(n_rows * n_cols, 1))
+    reversed_present = present[:, ::-1]
+    for start in range(0, n_rows, block):
+        common = reversed_present[start:start + block, None, :] & reversed_present[None, :, :]
+        last[start:start + block] = n_cols - 1 - np.argmax(common, axis=2)
+    index = np.arange(n_rows)
+    spread_latest = np.where(level_counts > 0, values[index[:, None], last] - values[index[None, :], last], np.nan)
+
+    return {
+        'correlation': correlation,
+        'observations': counts.astype(np.int64),
+        'spread_mean': spread_mean,
+        'spread_latest': spread_latest,
+    }
+
+
+def _numeric_matrix(frame):
+    """Convert value columns to a float matrix with 0 and non-numeric cells as NaN."""
+    columns = []
+    for col in frame.columns:
+        series = frame[col]
+        if series.dtype == object:
+            series = pd.to_numeric(series, errors='coerce')
+        if pd.api.types.is_numeric_dtype(series.dtype):
+            columns.append(series.to_numpy(dtype=np.float64, na_value=np.nan))
+        else:
+            # Dates, timedeltas and the like are never prices
+            columns.append(np.full(len(frame), np.nan))
+    if not columns:
+        return np.empty((len(frame), 0))
+    values = np.column_stack(columns)
+    values[values == 0] = np.nan
+    return values
+
+
+def _parse_date_axis(columns):
+    """Parse column headers into datetime64 values, NaT where a header is not a date."""
+    parsed = []
+    for col in columns:
+        try:
+            parsed.append(pd.Timestamp(col) if not isinstance(col, (int, float)) else pd.NaT)
+        except (ValueError, TypeError):
+            parsed.append(pd.NaT)
+    return pd.DatetimeIndex(parsed).to_numpy(dtype='datetime64[ns]')
+
+
+def _json_records(frame):
+    """Convert a frame to records with NaN and infinities as None."""
+    frame = frame.astype(object).where(frame.notna() & ~frame.isin([np.inf, -np.inf]), None)
+    return frame.to_dict('records')
+
+
+def _json_values(values):
+    """Convert a float array to a list with NaN and infinities as None."""
+    return [float(v) if np.isfinite(v) else None for v in values]
+
+
+def parse_range(params):
+    """Read start/end/months/freq query parameters, raising ValueError if invalid."""
+    bounds = {}
+    for name in ('start', 'end'):
+        value = params.get(name)
+        if value:
+            try:
+                bounds[name] = pd.Timestamp(value).to_datetime64().astype('datetime64[ns]')
+            except (ValueError, TypeError):
+                raise ValueError(f'Invalid {name} date: {value}')
+        else:
+            bounds[name] = None
+
+    months = params.get('months')
+    try:
+        bounds['months'] = int(months) if months not in (None, '') else None
+    except (ValueError, TypeError):
+        raise ValueError(f'Invalid months: {months}')
+    if bounds['months'] is not None and bounds['months'] <= 0:
+        raise ValueError('months must be a positive number')
+
+    freq = params.get('freq') or None
+    if freq is not None and freq not in RESAMPLE_RULES:
+        raise ValueError(f'Invalid freq {freq}, choose one of: {", ".join(RESAMPLE_RULES)}')
+    return bounds, freq
+
+
+def parse_overlays(params):
+    """Read the overlays (comma-separated metric names) and window parameters.
+
+    Returns (overlays, window) and raises ValueError if either is invalid.
+    """
+    overlays = params.get('overlays') or []
+    if isinstance(overlays, str):
+        overlays = [name.strip() for name in overlays.split(',') if name.strip()]
+    unknown = [name for name in overlays if name not in ROLLING_METRICS]
+    if unknown:
+        raise ValueError(f'Unknown overlays {", ".join(map(str, unknown))}, choose from: {", ".join(ROLLING_METRICS)}')
+
+    window = params.get('window')
+    try:
+        window = int(window) if window not in (None, '') else 3
+    except (ValueError, TypeError):
+        raise ValueError(f'Invalid window: {window}')
+    if not 2 <= window <= app.config['MAX_ROLLING_WINDOW']:
+        raise ValueError(f'window must be between 2 and {app.config["MAX_ROLLING_WINDOW"]}')
+    return overlays, window
+
+
+def parse_max_points(params):
+    """Read the optional max_points parameter, raising ValueError if invalid."""
+    max_points = params.get('max_points')
+    if max_points in (None, ''):
+        return None
+    try:
+        max_points = int(max_points)
+    except (ValueError, TypeError):
+        raise ValueError(f'Invalid max_points: {max_points}')
+    if max_points < 3:
+        raise ValueError('max_points must be at least 3')
+    return max_points
+
+
+def resample_series(dates, values, freq):
+    """Average a series into calendar periods, labelling each by its start date."""
+    valid = ~np.isnat(dates)
+    resampled = pd.Series(values[valid], index=pd.DatetimeIndex(dates[valid])).resample(RESAMPLE_RULES[freq]).mean().dropna()
+    index = resampled.index.to_numpy(dtype='datetime64[ns]')
+    return np.array([str(ts) for ts in resampled.index], dtype=object), index, resampled.to_numpy()
+
+
+def lttb_indices(x, y, threshold):
+    """Pick point indices with Largest-Triangle-Three-Buckets downsampling.
+
+    The first and last points are always kept. Every bucket in between
+    contributes the point forming the largest triangle with the previously
+    kept point and the average of the next bucket, so peaks and troughs
+    survive while the point count is bounded by threshold.
+    """
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    every = (n - 2) / (threshold - 2)
+    edges = np.floor(np.arange(threshold - 1) * every).astype(np.intp) + 1
+    edges[-1] = n - 1
+
+    indices = np.empty(threshold, dtype=np.intp)
+    indices[0] = 0
+    a = 0
+    for i in range(threshold - 2):
+        start, stop = edges[i], edges[i + 1]
+        next_start = stop
+        next_stop = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[next_start:next_stop].mean()
+        avg_y = y[next_start:next_stop].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:stop] - y[a]) - (x[a] - x[start:stop]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+    indices[-1] = n - 1
+    return indices
+
+
+def downsample_indices(dates, values, max_points):
+    """Return LTTB indices reducing a series to max_points, or None when it already fits.
+
+    Points are spaced by time when every date is known, by position otherwise.
+    """
+    if not max_points or len(values) <= max_points:
+        return None
+    x = dates.astype(np.int64) if not np.isnat(dates).any() else np.arange(len(values))
+    return lttb_indices(x, values, max_points)
+
+
+def split_frame(df):
+    """Split a parsed sheet into (meta, values, labels, dates) arrays."""
+    value_cols = [col for col in df.columns if col not in META_COLS]
+    return (
+        df[[col for col in META_COLS if col in df.columns]].reset_index(drop=True),
+        _numeric_matrix(df[value_cols]),
+        np.array([str(col) for col in value_cols], dtype=object),
+        _parse_date_axis(value_cols),
+    )
+
+
+def merge_sheets(parts):
+    """Stack per-sheet (meta, values, labels, dates) parts into one dataset.
+
+    parts is a list of (sheet_name, part) pairs. Date columns are matched by
+    header label across sheets, and every row gets its sheet name in the
+    Sheet metadata column.
+    """
+    labels = []
+    dates = []
+    positions = {}
+    for _, (_, _, sheet_labels, sheet_dates) in parts:
+        for label, date in zip(sheet_labels, sheet_dates):
+            if label not in positions:
+                positions[label] = len(labels)
+                labels.append(label)
+                dates.append(date)
+
+    total_rows = sum(len(meta) for _, (meta, _, _, _) in parts)
+    values = np.full((total_rows, len(labels)), np.nan)
+    metas = []
+    offset = 0
+    for sheet, (meta, sheet_values, sheet_labels, _) in parts:
+        columns = [positions[label] for label in sheet_labels]
+        values[offset:offset + len(meta), columns] = sheet_values
+        metas.append(meta.assign(**{SHEET_COL: sheet}))
+        offset += len(meta)
+
+    return (
+        pd.concat(metas, ignore_index=True),
+        values,
+        np.array(labels, dtype=object),
+        np.array(dates, dtype='datetime64[ns]'),
+    )
+
+
+def _column_key(label, date):
+    # Date headers match by date, so '2024-01-01' and '1/1/2024' are one month
+    return ('date', int(date.astype('datetime64[ns]').astype(np.int64))) if not np.isnat(date) else ('label', label)
+
+
+def merge_append(base, meta, values, labels, dates):
+    """Merge a parsed delta into a dataset by (Country, Location, Grade) key.
+
+    Delta rows update the matching row of the base (the first one, like
+    lookup) and unknown keys are appended; date columns missing from the
+    base are added. Empty delta cells leave the base value untouched.
+    Returns (meta, values, labels, dates, touched), where touched holds the
+    merged row positions whose values changed.
+    """
+    key_cols = REQUIRED_COLS + ([SHEET_COL] if base.sheets else [])
+    if (SHEET_COL in meta.columns) != bool(base.sheets):
+        raise IngestError('Appended data must have the same sheets as the dataset it extends')
+
+    # Map delta columns onto base columns, adding the ones the base lacks
+    positions = {_column_key(label, date): i for i, (label, date) in enumerate(zip(base.labels, base.dates))}
+    new_labels = []
+    new_dates = []
+    columns = np.empty(len(labels), dtype=np.intp)
+    for i, (label, date) in enumerate(zip(labels, dates)):
+        key = _column_key(label, date)
+        if key not in positions:
+            positions[key] = len(base.labels) + len(new_labels)
+            new_labels.append(label)
+            new_dates.append(date)
+        columns[i] = positions[key]
+
+    # Map delta rows onto base rows through a key index; only delta rows are visited
+    index = base.meta.groupby(key_cols, sort=False).indices
+    n_base = len(base.meta)
+    rows = np.empty(len(meta), dtype=np.intp)
+    appended = []
+    for i, key in enumerate(meta[key_cols].itertuples(index=False, name=None)):
+        matches = index.get(key)
+        if matches is not None:
+            rows[i] = matches[0]
+        else:
+            rows[i] = n_base + len(appended)
+            appended.append(i)
+
+    merged = np.full((n_base + len(appended), len(base.labels) + len(new_labels)), np.nan)
+    merged[:n_base, :len(base.labels)] = base.values
+    block = merged[rows[:, None], columns]
+    merged[rows[:, None], columns] = np.where(np.isnan(values), block, values)
+
+    changed = ~np.isnan(values).all(axis=1)
+    touched = np.union1d(rows[changed], np.arange(n_base, n_base + len(appended)))
+    merged_meta = pd.concat([base.meta, meta.iloc[appended].reindex(columns=base.meta.columns)],
+                            ignore_index=True)
+    return (
+        merged_meta,
+        merged,
+        np.concatenate([base.labels, np.array(new_labels, dtype=object)]),
+        np.concatenate([base.dates, np.array(new_dates, dtype='datetime64[ns]')]),
+        touched,
+    )
+
+
+def append_dataset(dataset_id, base, parts):
+    """Build the dataset for base plus a parsed delta, recomputing stats only for touched rows."""
+    meta, values, labels, dates, touched = merge_append(base, *parts)
+    dataset = Dataset(dataset_id, meta, values, labels, dates)
+    if base._stats is not None:
+        # Untouched rows keep their values, so their stats carry over as they are
+        stats = base._stats.reindex(range(len(meta)))
+        fresh = compute_stats(dataset.values[touched], dataset.dates)
+        stats.iloc[touched] = fresh[stats.columns].to_numpy()
+        stats['points'] = stats['points'].astype(np.int64)
+        dataset._stats = stats
+    return dataset
+
+
+def append_id(base_id, delta_id):
+    """Dataset id of base_id with the upload delta_id appended."""
+    return hashlib.sha256(f'{base_id}+{delta_id}'.encode()).hexdigest()
+
+
+class Dataset:
+    """A parsed workbook kept in memory, identified by the hash of its bytes.
+
+    The frame is split once into a metadata block (Country, Location, Grade,
+    Unit) and a dense rows x dates float matrix, so extracting a series is a
+    row slice plus a NaN mask.
+    """
+
+    def __init__(self, dataset_id, meta, values, labels, dates):
+        # Keep date columns in ascending order, headers that are not dates last
+        order = np.argsort(dates, kind='stable')
+        if not np.array_equal(order, np.arange(len(order))):
+            values, labels, dates = values[:, order], labels[order], dates[order]
+
+        self.dataset_id = dataset_id
+        self.meta = meta
+        self.values = values
+        self.labels = labels
+        self.dates = dates
+        self.dated_columns = int((~np.isnat(dates)).sum())
+        # A memory-mapped matrix lives in the shared store, not in this process.
+        # It still counts against the cache budget: each cached dataset holds a
+        # store reference, and referenced datasets cannot be evicted from the store.
+        self.shared = isinstance(values, np.memmap)
+        self.nbytes = int(self.meta.memory_usage(deep=True).sum()) + self.dates.nbytes + self.values.nbytes
+        self._stats = None
+        self._stats_lock = threading.Lock()
+        self._filters = None
+        self._filters_lock = threading.Lock()
+        self._rolling = OrderedDict()
+        self._rolling_bytes = 0
+        self._rolling_lock = threading.Lock()
+        self._correlations = OrderedDict()
+        self._correlations_lock = threading.Lock()
+
+        # Hash indexes from key tuples to row positions, built once at ingest.
+        # The same key legitimately repeats across sheets, so duplicates are
+        # only counted within a sheet.
+        self.sheets = self.meta[SHEET_COL].unique().tolist() if SHEET_COL in self.meta.columns else []
+        self.index = self.meta.groupby(['Location', 'Grade'], sort=False).indices
+        self.country_index = self.meta.groupby(['Country', 'Location', 'Grade'], sort=False).indices
+        self.location_index = self.meta.groupby('Location', sort=False).indices
+        self.grade_index = self.meta.groupby('Grade', sort=False).indices
+        if self.sheets:
+            self.sheet_index = self.meta.groupby([SHEET_COL, 'Location', 'Grade'], sort=False).indices
+            keys = self.sheet_index
+        else:
+            self.sheet_index = {}
+            keys = self.index
+        self.duplicate_keys = [key for key, rows in keys.items() if len(rows) > 1]
+        if self.duplicate_keys:
+            app.logger.warning('Dataset %s has %d duplicate Location/Grade keys, using the first row of each',
+                               dataset_id, len(self.duplicate_keys))
+
+    @classmethod
+    def from_frame(cls, dataset_id, df):
+        """Build a dataset from a freshly parsed sheet."""
+        return cls(dataset_id, *split_frame(df))
+
+    def lookup(self, location, grade, country=None, sheet=None):
+        """Return the row position for a key, or None if it is not present."""
+        if sheet:
+            rows = self.sheet_index.get((sheet, location, grade))
+            if rows is not None and country:
+                rows = rows[self.meta['Country'].to_numpy()[rows] == country]
+        elif country:
+            rows = self.country_index.get((country, location, grade))
+        else:
+            rows = self.index.get((location, grade))
+        if rows is None or len(rows) == 0:
+            return None
+        return int(rows[0])
+
+    def find_rows(self, location=None, grade=None, country=None, sheet=None):
+        """Return the row positions matching a key, where None or '*' matches anything.
+
+        A fully specified key in a multi-sheet dataset matches its row in
+        every sheet unless a sheet is given.
+        """
+        location = None if location == '*' else location
+        grade = None if grade == '*' else grade
+        country = None if country == '*' else country
+        sheet = None if sheet == '*' else sheet
+
+        if location is not None and grade is not None and (sheet is not None or not self.sheets):
+            position = self.lookup(location, grade, country, sheet)
+            return np.array([] if position is None else [position], dtype=np.intp)
+        if location is not None and grade is not None:
+            rows = self.index.get((location, grade), np.array([], dtype=np.intp))
+            if country is not None:
+                rows = rows[self.meta['Country'].to_numpy()[rows] == country]
+            return rows
+        if location is not None:
+            rows = self.location_index.get(location, np.array([], dtype=np.intp))
+        elif grade is not None:
+            rows = self.grade_index.get(grade, np.array([], dtype=np.intp))
+        else:
+            rows = np.arange(len(self.meta))
+        if country is not None:
+            rows = rows[self.meta['Country'].to_numpy()[rows] == country]
+        if sheet is not None and self.sheets:
+            rows = rows[self.meta[SHEET_COL].to_numpy()[rows] == sheet]
+        return rows
+
+    def column_slice(self, start=None, end=None, months=None):
+        """Return the slice of date columns between start and end, inclusive.
+
+        months selects the last N months up to end (or the latest date).
+        Bounds are found by binary search on the sorted date axis; columns
+        whose header is not a date are only included without any bounds.
+        """
+        if start is None and end is None and not months:
+            return slice(None)
+        axis = self.dates[:self.dated_columns]
+        start_side = 'left'
+        if months and axis.size:
+            # The last N months exclude the date exactly N months before the end
+            last = end if end is not None else axis[-1]
+            start = (pd.Timestamp(last) - pd.DateOffset(months=months)).to_datetime64()
+            start_side = 'right'
+        i = int(np.searchsorted(axis, start, side=start_side)) if start is not None else 0
+        j = int(np.searchsorted(axis, end, side='right')) if end is not None else len(axis)
+        return slice(i, max(i, j))
+
+    def series_block(self, rows, columns=slice(None)):
+        """Return (labels, dates, values) for many rows from one slice of the matrix."""
+        block = self.values[rows, columns]
+        labels = self.labels[columns]
+        dates = self.dates[columns]
+        mask = ~np.isnan(block)
+        return [(labels[m], dates[m], v[m]) for v, m in zip(block, mask)]
+
+    def series(self, position, columns=slice(None)):
+        """Return the (labels, dates, values) of a row, skipping empty and zero cells."""
+        row = self.values[position, columns]
+        mask = ~np.isnan(row)
+        return self.labels[columns][mask], self.dates[columns][mask], row[mask]
+
+    @property
+    def stats(self):
+        """Per-row summary statistics, computed once and then cached."""
+        if self._stats is None:
+            with self._stats_lock:
+                if self._stats is None:
+                    self._stats = compute_stats(self.values, self.dates)
+        return self._stats
+
+    @property
+    def filters(self):
+        """Index of the key combinations that have prices, built once from the stats."""
+        if self._filters is None:
+            with self._filters_lock:
+                if self._filters is None:
+                    self._filters = FilterIndex(self.meta, self.stats['points'].to_numpy() > 0)
+        return self._filters
+
+    def row_stats(self, position):
+        """Return one row's statistics as a JSON-ready dict."""
+        return _json_records(self.stats.iloc[[position]])[0]
+
+    def rolling(self, names, window, rows=None):
+        """The named rolling analytics for the given rows (every row by default).
+
+        Each metric matrix is computed for the whole dataset and cached on its
+        own, keyed by window for the windowed metrics, within
+        ROLLING_CACHE_MAX_BYTES per dataset. When the requested matrices would
+        not fit the budget together, only the requested rows are computed and
+        nothing is cached.
+        """
+        keys = {name: (name, window if name in WINDOWED_METRICS else None) for name in names}
+        budget = app.config['ROLLING_CACHE_MAX_BYTES']
+        if self.values.nbytes * len(keys) > budget:
+            values = self.values if rows is None else self.values[rows]
+            return compute_rolling(values, self.dates, window, names)
+
+        metrics = {}
+        with self._rolling_lock:
+            for name, key in keys.items():
+                if key in self._rolling:
+                    self._rolling.move_to_end(key)
+                    metrics[name] = self._rolling[key]
+        missing = [name for name in names if name not in metrics]
+        if missing:
+            computed = compute_rolling(self.values, self.dates, window, missing)
+            metrics.update(computed)
+            with self._rolling_lock:
+                for name, matrix in computed.items():
+                    if keys[name] in self._rolling:
+                        continue
+                    self._rolling[keys[name]] = matrix
+                    self._rolling_bytes += matrix.nbytes
+                # The matrices just added fit the budget, so only older ones go
+                while self._rolling_bytes > budget:
+                    _, oldest = self._rolling.popitem(last=False)
+                    self._rolling_bytes -= oldest.nbytes
+        if rows is None:
+            return metrics
+        return {name: matrix[rows] for name, matrix in metrics.items()}
+
+    def correlation(self, rows, columns=slice(None), basis='returns'):
+        """Correlation and spreads between rows over a column slice, cached per selection."""
+        key = (tuple(int(row) for row in rows), columns.start, columns.stop, basis)
+        with self._correlations_lock:
+            result = self._correlations.get(key)
+            if result is not None:
+                self._correlations.move_to_end(key)
+                return result
+        result = compute_correlation(self.values[rows, columns], basis)
+        with self._correlations_lock:
+            self._correlations[key] = result
+            while len(self._correlations) > CORRELATION_CACHE_SIZE:
+                self._correlations.popitem(last=False)
+        return result
+
+    def row_overlays(self, position, columns, names, window):
+        """Return the named rolling metrics of a row, aligned with series(position, columns)."""
+        return self.block_overlays([position], columns, names, window)[0]
+
+    def block_overlays(self, rows, columns, names, window):
+        """Return the named rolling metrics of many rows, aligned with series_block(rows, columns)."""
+        if not names:
+            return [{} for _ in rows]
+        metrics = self.rolling(names, window, rows)
+        mask = ~np.isnan(self.values[rows, columns])
+        return [{name: metrics[name][i, columns][m] for name in names} for i, m in enumerate(mask)]
+
+
+class FilterIndex:
+    """The (Country, Location, Grade[, Sheet]) combinations of a dataset that have prices.
+
+    Each dimension is factorised over the distinct combinations, so the
+    options left for one dropdown given the others' selections are a few
+    vectorised code comparisons and a bincount, however large the dataset.
+    """
+
+    # Option lists are named as in the /upload response
+    NAMES = {'Country': 'countries', 'Location': 'locations', 'Grade': 'grades', SHEET_COL: 'sheets'}
+
+    def __init__(self, meta, has_data):
+        columns = [column for column in self.NAMES if column in meta.columns]
+        combinations = meta.loc[has_data, columns].drop_duplicates()
+        self.size = len(combinations)
+        self.values = {}
+        self.codes = {}
+        self._positions = {}
+        for column in columns:
+            # Sheets keep workbook order, the rest are listed alphabetically; empty cells get code -1
+            codes, uniques = pd.factorize(combinations[column], sort=column != SHEET_COL)
+            self.values[column] = uniques.tolist()
+            self.codes[column] = codes
+            self._positions[column] = {value: i for i, value in enumerate(self.values[column])}
+
+    def options(self, selected):
+        """Return the values of every dimension that combine with the selections of the others.
+
+        selected maps meta column names to a value, where None, '' or '*'
+        leave the dimension open. A dimension is narrowed by the other
+        selections only, so a selected value stays listed alongside its
+        alternatives. Also returns how many combinations match them all.
+        """
+        masks = {}
+        for column, value in selected.items():
+            if column in self.codes and value not in (None, '', '*'):
+                masks[column] = self.codes[column] == self._positions[column].get(value, -2)
+
+        options = {}
+        for column, codes in self.codes.items():
+            mask = None
+            for other, other_mask in masks.items():
+                if other != column:
+                    mask = other_mask if mask is None else mask & other_mask
+            codes = codes if mask is None else codes[mask]
+            present = np.bincount(codes[codes >= 0], minlength=len(self.values[column])) > 0
+            options[self.NAMES[column]] = [value for value, ok in zip(self.values[column], present) if ok]
+
+        matching = np.ones(self.size, dtype=bool)
+        for mask in masks.values():
+            matching &= mask
+        options['combinations'] = int(matching.sum())
+        return options
+
+
+class DatasetCache:
+    """Thread-safe LRU cache of parsed datasets bounded by a memory budget."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, dataset_id):
+        with self._lock:
+            dataset = self._items.get(dataset_id)
+            if dataset is not None:
+                self._items.move_to_end(dataset_id)
+            return dataset
+
+    def put(self, dataset):
+        with self._lock:
+            old = self._items.pop(dataset.dataset_id, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            self._items[dataset.dataset_id] = dataset
+            self._bytes += dataset.nbytes
+
+            # Evict least recently used datasets, but never the one just added
+            evicted = []
+            while self._bytes > self.max_bytes and len(self._items) > 1:
+                _, oldest = self._items.popitem(last=False)
+                self._bytes -= oldest.nbytes
+                evicted.append(oldest)
+        # Let the shared store reclaim datasets no process holds any more
+        for oldest in evicted:
+            if oldest.shared:
+                detach_stored_dataset(oldest.dataset_id)
+        return dataset
+
+    def usage(self):
+        """Return (total bytes, [(dataset_id, bytes), ...]) for the cached datasets."""
+        with self._lock:
+            return self._bytes, [(dataset_id, dataset.nbytes) for dataset_id, dataset in self._items.items()]
+
+
+dataset_cache = DatasetCache(app.config['DATASET_CACHE_MAX_BYTES'])
+
+
+def _file_head(source, size=8):
+    """Return the first bytes of a workbook given as bytes or a path."""
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source[:size])
+    with open(source, 'rb') as f:
+        return f.read(size)
+
+
+@contextmanager
+def _open_source(source):
+    """Open a workbook given as raw bytes, a path or a file object.
+
+    Paths are opened here rather than handed to openpyxl, which rejects
+    files without an Excel extension such as spooled uploads.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        yield io.BytesIO(source)
+    elif isinstance(source, str):
+        with open(source, 'rb') as f:
+            yield f
+    else:
+        yield source
+
+
+def _read_pandas(source, usecols=None, engine=None, progress=None, sheet=0):
+    """Read a sheet through pandas (openpyxl or xlrd, or an explicit engine)."""
+    with _open_source(source) as f:
+        if usecols is not None:
+            wanted = set(usecols)
+            return pd.read_excel(f, sheet_name=sheet, engine=engine, usecols=lambda col: col in wanted)
+        return pd.read_excel(f, sheet_name=sheet, engine=engine)
+
+
+def _read_calamine(source, usecols=None, progress=None, sheet=0):
+    return _read_pandas(source, usecols, engine='calamine', sheet=sheet)
+
+
+def _read_openpyxl_stream(source, usecols=None, progress=None, sheet=0):
+    """Stream a sheet row by row from a read-only openpyxl workbook.
+
+    Rows are collected as plain value tuples, skipping pandas' per-cell
+    conversion. With usecols, each row stops at the last wanted column.
+    progress, if given, is called with the number of rows read so far.
+    sheet=None reads every sheet into a {name: frame} dict.
+    """
+    with _open_source(source) as f:
+        workbook = openpyxl.load_workbook(f, read_only=True, data_only=True)
+        try:
+            if sheet is None:
+                return {worksheet.title: _stream_rows(worksheet, usecols, progress) for worksheet in workbook.worksheets}
+            worksheet = workbook.worksheets[sheet] if isinstance(sheet, int) else workbook[sheet]
+            return _stream_rows(worksheet, usecols, progress)
+        finally:
+            workbook.close()
+
+
+def _stream_rows(worksheet, usecols, progress):
+    """Read a sheet of an open read-only workbook into a DataFrame."""
+    rows = worksheet.iter_rows(values_only=True)
+    header = []
+    seen = {}
+    for i, col in enumerate(next(rows, ())):
+        # Name blank and repeated headers the way pd.read_excel does
+        name = f'Unnamed: {i}' if col is None else col
+        if name in seen:
+            seen[name] += 1
+            name = f'{name}.{seen[name]}'
+        else:
+            seen[name] = 0
+        header.append(name)
+
+    if usecols is not None:
+        wanted = set(usecols)
+        positions = [i for i, col in enumerate(header) if col in wanted]
+        last_col = max(positions) + 1 if positions else 0
+        rows = worksheet.iter_rows(min_row=2, max_col=max(last_col, 1), values_only=True)
+    else:
+        positions = list(range(len(header)))
+
+    records = []
+    for row in rows:
+        record = [row[i] if i < len(row) else None for i in positions]
+        # Fully blank rows are skipped, as with pd.read_excel
+        if any(value is not None for value in record):
+            records.append(record)
+            if progress is not None and len(records) % 1000 == 0:
+                progress(len(records))
+    return pd.DataFrame(records, columns=[header[i] for i in positions])
+
+
+EXCEL_READERS = {
+    'openpyxl': _read_pandas,
+    'openpyxl-readonly': _read_openpyxl_stream,
+    'calamine': _read_calamine,
+}
+
+
+def available_readers():
+    """Return the reader engine names usable in this environment."""
+    names = ['openpyxl', 'openpyxl-readonly']
+    try:
+        import python_calamine  # noqa: F401
+        names.append('calamine')
+    except ImportError:
+        pass
+    return names
+
+
+def resolve_reader(name=None):
+    """Pick a reader engine by name, where 'auto' prefers the fastest installed one."""
+    name = name or app.config['EXCEL_READER']
+    if name == 'auto':
+        return 'calamine' if 'calamine' in available_readers() else 'openpyxl-readonly'
+    if name not in EXCEL_READERS:
+        raise ValueError(f'Unknown Excel reader: {name}')
+    if name not in available_readers():
+        raise ValueError(f'Excel reader {name} is not installed')
+    return name
+
+
+def read_excel(source, usecols=None, engine=None, progress=None, sheet=0):
+    """Read one sheet (the first by default) with the configured reader engine.
+
+    sheet=None reads every sheet into a {name: frame} dict from a single
+    open of the workbook, as pd.read_excel does.
+    """
+    engine = resolve_reader(engine)
+    if engine == 'openpyxl-readonly' and _file_head(source)[:2] != b'PK':
+        # Legacy .xls files are not zip archives; openpyxl cannot stream them
+        engine = 'openpyxl'
+    return EXCEL_READERS[engine](source, usecols=usecols, progress=progress, sheet=sheet)
+
+
+def _brotli():
+    try:
+        import brotli
+        return brotli
+    except ImportError:
+        return None
+
+
+def _has_pyarrow():
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def detect_format(source):
+    """Identify an upload as 'excel', 'parquet' or 'csv' from its leading bytes."""
+    head = _file_head(source)
+    if head[:4] == b'PAR1':
+        return 'parquet'
+    # .xlsx files are zip archives and .xls files are OLE compound documents
+    if head[:2] == b'PK' or head[:8] == b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1':
+        return 'excel'
+    return 'csv'
+
+
+FORMAT_NAMES = {'excel': 'Excel', 'csv': 'CSV', 'parquet': 'Parquet'}
+
+
+def _read_csv(source, usecols=None):
+    """Read a CSV file, through pyarrow's multithreaded reader when it is installed."""
+    with _open_source(source) as f:
+        columns = None
+        if usecols is not None:
+            # Project onto the wanted columns that the header actually has
+            header = pd.read_csv(f, nrows=0).columns
+            columns = [col for col in header if col in set(usecols)]
+            f.seek(0)
+        if _has_pyarrow():
+            from pyarrow import csv as pa_csv
+            convert_options = pa_csv.ConvertOptions(include_columns=columns) if columns is not None else None
+            return pa_csv.read_csv(f, convert_options=convert_options).to_pandas()
+        return pd.read_csv(f, usecols=columns)
+
+
+def _read_parquet(source, usecols=None):
+    """Read a Parquet file, loading only the wanted columns when usecols is given."""
+    if not _has_pyarrow():
+        raise ValueError('Parquet support requires pyarrow (pip install pyarrow)')
+    import pyarrow.parquet as pq
+    with _open_source(source) as f:
+        columns = None
+        if usecols is not None:
+            columns = [col for col in pq.read_schema(f).names if col in set(usecols)]
+            f.seek(0)
+        return pq.read_table(f, columns=columns).to_pandas()
+
+
+def read_table(source, usecols=None, progress=None, sheet=0, engine=None):
+    """Read an uploaded Excel, CSV or Parquet file into a DataFrame.
+
+    Every format yields the same Country/Location/Grade + date-column frame;
+    sheet only applies to Excel workbooks. With sheet=None the result is a
+    {sheet: frame} dict, where CSV and Parquet files hold sheet 0.
+    """
+    fmt = detect_format(source)
+    if fmt == 'parquet':
+        frame = _read_parquet(source, usecols)
+        return {0: frame} if sheet is None else frame
+    if fmt == 'csv':
+        frame = _read_csv(source, usecols)
+        return {0: frame} if sheet is None else frame
+    return read_excel(source, usecols=usecols, engine=engine, progress=progress, sheet=sheet)
+
+
+def data_sheets(source):
+    """Return the names of the sheets whose header row has the required columns.
+
+    Only the first row of each sheet is read, so notes and chart tabs are
+    ruled out before any parse. CSV and Parquet files hold a single table,
+    reported as sheet 0.
+    """
+    if detect_format(source) != 'excel':
+        return [0]
+    with _open_source(source) as f:
+        if _file_head(source)[:2] == b'PK':
+            workbook = openpyxl.load_workbook(f, read_only=True)
+            try:
+                headers = {worksheet.title: next(worksheet.iter_rows(max_row=1, values_only=True), ())
+                           for worksheet in workbook.worksheets}
+            finally:
+                workbook.close()
+        else:
+            workbook = pd.ExcelFile(f)
+            headers = {name: workbook.parse(name, nrows=0).columns for name in workbook.sheet_names}
+    return [name for name, header in headers.items() if all(col in set(header) for col in REQUIRED_COLS)]
+
+
+def _store_path(dataset_id):
+    # Ids are hex digests; refuse anything that could escape the store directory
+    if not dataset_id or not all(c in '0123456789abcdef' for c in dataset_id):
+        return None
+    return os.path.join(app.config['DATASET_STORE_DIR'], dataset_id)
+
+
+def save_dataset(dataset):
+    """Write a dataset to the on-disk store as .npy arrays plus JSON metadata.
+
+    The directory is written under a temporary name and renamed into place,
+    so readers in other processes never see a partial dataset. Precomputed
+    stats are stored too, so processes attaching later skip that pass.
+    """
+    path = _store_path(dataset.dataset_id)
+    if path is None or os.path.isdir(path):
+        return
+    os.makedirs(app.config['DATASET_STORE_DIR'], exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix='.tmp-', dir=app.config['DATASET_STORE_DIR'])
+    try:
+        np.save(os.path.join(tmp_path, 'values.npy'), np.ascontiguousarray(dataset.values))
+        np.save(os.path.join(tmp_path, 'dates.npy'), dataset.dates)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            f.write(dataset.meta.to_json(orient='split', index=False, date_format='iso'))
+        with open(os.path.join(tmp_path, 'labels.json'), 'w') as f:
+            json.dump(dataset.labels.tolist(), f)
+        if dataset._stats is not None:
+            np.save(os.path.join(tmp_path, 'stats.npy'), dataset._stats.to_numpy(dtype=np.float64))
+            with open(os.path.join(tmp_path, 'stats.json'), 'w') as f:
+                json.dump(dataset._stats.columns.tolist(), f)
+        os.makedirs(os.path.join(tmp_path, 'refs'))
+        os.rename(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isdir(path):
+            raise
+    evict_stored_datasets(app.config['DATASET_STORE_MAX_BYTES'], keep=dataset.dataset_id)
+
+
+def load_stored_dataset(dataset_id):
+    """Attach to a stored dataset with its value matrix memory-mapped, or return None.
+
+    Every process maps the same file, so the matrix is held once per host
+    however many workers use it. The attachment is recorded as a reference
+    that keeps the dataset from being evicted while this process lives.
+    """
+    path = _store_path(dataset_id)
+    if path is None or not os.path.isdir(path):
+        return None
+    try:
+        # Reference first, so an eviction racing with this load sees it
+        os.makedirs(os.path.join(path, 'refs'), exist_ok=True)
+        with open(os.path.join(path, 'refs', str(os.getpid())), 'w'):
+            pass
+        os.utime(path)
+        values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r')
+        dates = np.load(os.path.join(path, 'dates.npy'))
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = pd.read_json(io.StringIO(f.read()), orient='split', dtype=False, convert_dates=False)
+        with open(os.path.join(path, 'labels.json')) as f:
+            labels = np.array(json.load(f), dtype=object)
+        stats = None
+        if os.path.exists(os.path.join(path, 'stats.npy')):
+            with open(os.path.join(path, 'stats.json')) as f:
+                stats = pd.DataFrame(np.load(os.path.join(path, 'stats.npy')), columns=json.load(f))
+            stats['points'] = stats['points'].astype(np.int64)
+    except (OSError, ValueError) as e:
+        app.logger.warning('Could not load stored dataset %s: %s', dataset_id, e)
+        return None
+    dataset = Dataset(dataset_id, meta, values, labels, dates)
+    dataset._stats = stats
+    return dataset
+
+
+def detach_stored_dataset(dataset_id):
+    """Drop this process's reference to a stored dataset."""
+    path = _store_path(dataset_id)
+    if path is None:
+        return
+    try:
+        os.remove(os.path.join(path, 'refs', str(os.getpid())))
+    except OSError:
+        pass
+
+
+_claim_tokens = {}
+
+
+def _claim_path(dataset_id):
+    return os.path.join(app.config['DATASET_STORE_DIR'], f'.parsing-{dataset_id}')
+
+
+def try_claim_parse(dataset_id):
+    """Host-wide single flight: try to claim the parse of dataset_id without waiting.
+
+    Returns 'claimed' when this process should parse (inside holding_claim),
+    'stored' when the dataset is already in the store, or 'busy' while a live
+    process holds the claim. The claim is a file created exclusively in the
+    store; one left by a dead process or not refreshed for
+    PARSE_CLAIM_TIMEOUT_SECONDS is taken over.
+    """
+    stored = _store_path(dataset_id)
+    if stored is None:
+        return 'claimed'
+    path = _claim_path(dataset_id)
+    try:
+        os.makedirs(app.config['DATASET_STORE_DIR'], exist_ok=True)
+    except OSError:
+        # No store to share through; parse in this process only
+        return 'claimed'
+    while True:
+        if os.path.isdir(stored):
+            return 'stored'
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not _take_over_stale_claim(path):
+                return 'busy'
+            continue
+        except OSError:
+            return 'claimed'
+        token = uuid.uuid4().hex
+        with os.fdopen(fd, 'w') as f:
+            f.write(f'{os.getpid()} {token}')
+        _claim_tokens[dataset_id] = token
+        if os.path.isdir(stored):
+            # Stored by the previous owner just before it released its claim
+            release_parse(dataset_id)
+            return 'stored'
+        return 'claimed'
+
+
+def _take_over_stale_claim(path):
+    """Remove the claim at path if its owner died or stopped refreshing it; True once it is gone."""
+    try:
+        with open(path) as f:
+            content = f.read()
+        age = time.time() - os.stat(path).st_mtime
+    except FileNotFoundError:
+        return True
+    except OSError:
+        return False
+    owner = content.split(' ')[0]
+    dead = owner.isdigit() and not _pid_alive(int(owner))
+    if not dead and age <= app.config['PARSE_CLAIM_TIMEOUT_SECONDS']:
+        return False
+    # Move it aside under a name of our own rather than removing it, so two
+    # waiters cannot both delete it and take out the claim one of them just made
+    aside = f'{path}.stale-{uuid.uuid4().hex}'
+    try:
+        os.rename(path, aside)
+    except FileNotFoundError:
+        return True
+    except OSError:
+        return False
+    try:
+        with open(aside) as f:
+            if f.read() != content:
+                # Lost the race: this is a fresh claim made after our check, put it back
+                try:
+                    os.link(aside, path)
+                except OSError:
+                    pass
+                return False
+    except OSError:
+        return False
+    finally:
+        try:
+            os.remove(aside)
+        except OSError:
+            pass
+    return True
+
+
+@contextmanager
+def holding_claim(dataset_id):
+    """Keep this process's claim on dataset_id fresh while the block runs, then release it."""
+    path = _claim_path(dataset_id)
+    stop = threading.Event()
+    interval = max(app.config['PARSE_CLAIM_TIMEOUT_SECONDS'] / 4, 1)
+
+    def refresh():
+        while not stop.wait(interval):
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+
+    heartbeat = threading.Thread(target=refresh, name=f'claim-{dataset_id[:8]}', daemon=True)
+    heartbeat.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        heartbeat.join()
+        release_parse(dataset_id)
+
+
+def release_parse(dataset_id):
+    """Remove the claim on dataset_id if it is still the one this process made."""
+    token = _claim_tokens.pop(dataset_id, None)
+    if token is None:
+        return
+    path = _claim_path(dataset_id)
+    try:
+        with open(path) as f:
+            if f.read() != f'{os.getpid()} {token}':
+                return
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def stored_datasets():
+    """Return [(dataset_id, bytes, live references, last used)] for the store, pruning dead references."""
+    store_dir = app.config['DATASET_STORE_DIR']
+    if not os.path.isdir(store_dir):
+        return []
+    entries = []
+    for dataset_id in os.listdir(store_dir):
+        path = _store_path(dataset_id)
+        if path is None or not os.path.isdir(path):
+            continue
+        try:
+            size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+            refs = 0
+            refs_dir = os.path.join(path, 'refs')
+            for name in os.listdir(refs_dir) if os.path.isdir(refs_dir) else []:
+                if name.isdigit() and _pid_alive(int(name)):
+                    refs += 1
+                else:
+                    # The process that held this reference has exited
+                    os.remove(os.path.join(refs_dir, name))
+            entries.append((dataset_id, size, refs, os.stat(path).st_mtime))
+        except OSError:
+            continue
+    return entries
+
+
+def evict_stored_datasets(max_bytes, keep=None):
+    """Remove least recently used unreferenced datasets until the store fits max_bytes.
+
+    A dataset is renamed out of the way before it is deleted, so no process
+    can attach to one half removed; processes that already mapped it keep
+    their mapping until they let go.
+    """
+    entries = stored_datasets()
+    total = sum(size for _, size, _, _ in entries)
+    for dataset_id, size, refs, _ in sorted(entries, key=lambda entry: entry[3]):
+        if total <= max_bytes:
+            break
+        if refs or dataset_id == keep:
+            continue
+        path = _store_path(dataset_id)
+        doomed = os.path.join(app.config['DATASET_STORE_DIR'], f'.evict-{dataset_id}-{uuid.uuid4().hex}')
+        try:
+            os.rename(path, doomed)
+        except OSError:
+            continue
+        shutil.rmtree(doomed, ignore_errors=True)
+        total -= size
+    return total
+
+
+def _upload_dir():
+    os.makedirs(app.config['UPLOAD_DIR'], exist_ok=True)
+    return app.config['UPLOAD_DIR']
+
+
+def _copy_stream(stream, f, hasher, limit):
+    """Copy a request stream to a file in blocks, hashing as it goes if hasher is given."""
+    written = 0
+    while True:
+        block = stream.read(1024 * 1024)
+        if not block:
+            return written
+        written += len(block)
+        if written > limit:
+            raise IngestError('File is too large', 413)
+        if hasher is not None:
+            hasher.update(block)
+        f.write(block)
+
+
+def spool_upload(stream):
+    """Stream an upload to a temp file, returning (dataset_id, path).
+
+    The body is hashed while it is written, so it is never held in memory
+    as a whole and the dataset id is known once the last block lands.
+    """
+    hasher = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=_upload_dir(), suffix='.upload', delete=False) as f:
+        try:
+            _copy_stream(stream, f, hasher, app.config['MAX_UPLOAD_BYTES'])
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    return hasher.hexdigest(), f.name
+
+
+def discard_upload(source):
+    """Remove a spooled upload file; bytes sources need no cleanup."""
+    if isinstance(source, str):
+        try:
+            os.remove(source)
+        except FileNotFoundError:
+            pass
+
+
+class UploadSession:
+    """A resumable upload assembled from sequential chunks in UPLOAD_DIR.
+
+    The session lives on disk only: the chunks so far in <id>.part, whose
+    size is the offset, and the declared filename and size in <id>.json.
+    Any worker process can take the next chunk or complete the upload;
+    appends hold an exclusive lock on the part file.
+    """
+
+    def __init__(self, upload_id, filename=None, size=None):
+        self.upload_id = upload_id
+        self.filename = filename
+        self.size = size
+        self.path = os.path.join(_upload_dir(), f'{upload_id}.part')
+        self.info_path = os.path.join(_upload_dir(), f'{upload_id}.json')
+
+    @classmethod
+    def create(cls, filename, size):
+        session = cls(uuid.uuid4().hex, filename, size)
+        open(session.path, 'wb').close()
+        with open(session.info_path, 'w') as f:
+            json.dump({'filename': filename, 'size': size}, f)
+        return session
+
+    @classmethod
+    def load(cls, upload_id):
+        """Return the session for upload_id, or None if it is unknown, expired or completed."""
+        if not all(c in '0123456789abcdef' for c in upload_id):
+            return None
+        session = cls(upload_id)
+        try:
+            with open(session.info_path) as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            return None
+        session.filename = info.get('filename')
+        session.size = info.get('size')
+        return session if os.path.exists(session.path) else None
+
+    @property
+    def offset(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def append(self, stream, offset):
+        """Append a chunk that must start at the current offset."""
+        with open(self.path, 'r+b') as f:
+            _lock_file(f)
+            current = f.seek(0, os.SEEK_END)
+            if offset != current:
+                return False
+            try:
+                _copy_stream(stream, f, None, app.config['MAX_UPLOAD_BYTES'] - current)
+            except BaseException:
+                # Drop the partial chunk so the client can resend it
+                f.truncate(current)
+                raise
+        return True
+
+    def complete(self):
+        """Hand the assembled file over for ingestion, returning (dataset_id, path).
+
+        Returns None when another request completed the session first, and
+        raises IngestError (409) while bytes are still missing.
+        """
+        spooled = os.path.join(_upload_dir(), f'{self.upload_id}.upload')
+        try:
+            with open(self.path, 'rb') as f:
+                _lock_file(f)
+                received = f.seek(0, os.SEEK_END)
+                if self.size is not None and received != self.size:
+                    raise IngestError(f'Upload is incomplete: {received} of {self.size} bytes received', 409)
+                # Renaming claims the file, so only one completion goes ahead
+                os.rename(self.path, spooled)
+        except FileNotFoundError:
+            return None
+        discard_upload(self.info_path)
+
+        hasher = hashlib.sha256()
+        with open(spooled, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                hasher.update(block)
+        return hasher.hexdigest(), spooled
+
+    def to_dict(self):
+        return {
+            'upload_id': self.upload_id,
+            'offset': self.offset,
+            'size': self.size,
+            'chunk_size': app.config['UPLOAD_CHUNK_BYTES'],
+            'upload_url': f'/uploads/{self.upload_id}',
+            'complete_url': f'/uploads/{self.upload_id}/complete',
+        }
+
+
+def _lock_file(f):
+    """Hold an exclusive lock on an open file until it is closed (POSIX only)."""
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+
+def create_upload_session(filename, size):
+    # Abandoned sessions are dropped along with their partial files
+    cutoff = time.time() - app.config['UPLOAD_SESSION_SECONDS']
+    for name in os.listdir(_upload_dir()):
+        if name.endswith('.json'):
+            session = UploadSession(name[:-len('.json')])
+            try:
+                updated = max(os.path.getmtime(path) for path in (session.path, session.info_path)
+                              if os.path.exists(path))
+            except ValueError:
+                continue
+            if updated < cutoff:
+                discard_upload(session.path)
+                discard_upload(session.info_path)
+    return UploadSession.create(filename, size)
+
+
+def get_upload_session(upload_id):
+    return UploadSession.load(upload_id)
+
+
+ingest_executor = ThreadPoolExecutor(max_workers=app.config['INGEST_WORKERS'], thread_name_prefix='ingest')
+# Jobs waiting on another worker's parse sleep here instead of holding an ingest thread
+_claim_waiters = ThreadPoolExecutor(max_workers=app.config['INGEST_WORKERS'], thread_name_prefix='claim-wait')
+_jobs = {}
+_pending = {}
+_pending_lock = threading.Lock()
+_shutting_down = threading.Event()
+
+
+def _job_marker_dir():
+    return os.path.join(app.config['DATASET_STORE_DIR'], '.jobs')
+
+
+def _job_marker_path(job_id):
+    return os.path.join(_job_marker_dir(), f'{job_id}.json')
+
+
+class IngestJob:
+    """Progress of one background ingestion, polled through /jobs/<job_id>.
+
+    Stages run queued -> discovering -> parsing -> indexing -> ready, or end
+    in failed. The dropdown options are available as soon as discovery is
+    done, while the numeric parse carries on. A job whose workbook another
+    worker is already parsing still runs discovery, then waits in the
+    waiting stage and attaches to that worker's result. Every stage change
+    is published to a job marker in the store, so a poll answered by another
+    worker sees it too.
+    """
+
+    def __init__(self, dataset_id):
+        self.job_id = uuid.uuid4().hex
+        self.dataset_id = dataset_id
+        self.stage = 'queued'
+        self.rows_total = None
+        self.rows_parsed = 0
+        self.options = None
+        self.error = None
+        self.error_status = None
+        self.created = time.time()
+        self.parse_started = None
+        self.finished = None
+        self.discovered = threading.Event()
+        self.future = None
+
+    def set_stage(self, stage):
+        self.stage = stage
+        if stage == 'parsing':
+            self.parse_started = time.time()
+        self.publish()
+
+    def report_rows(self, rows):
+        self.rows_parsed = rows
+
+    def fail(self, message, status):
+        self.error = message
+        self.error_status = status
+        self.stage = 'failed'
+        self.finished = time.time()
+        self.discovered.set()
+        self.publish()
+
+    def publish(self):
+        """Write the job's status to its marker in the store, for the other workers to serve."""
+        path = _job_marker_path(self.job_id)
+        partial = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(partial, 'w') as f:
+                json.dump({'pid': os.getpid(), 'status': self.to_dict()}, f)
+            os.replace(partial, path)
+        except OSError:
+            # No shared store; polls answered by this worker still see the job
+            try:
+                os.remove(partial)
+            except OSError:
+                pass
+
+    def to_dict(self):
+        now = self.finished or time.time()
+        progress = None
+        eta = None
+        if self.stage == 'ready':
+            progress = 1.0
+        elif self.rows_total:
+            progress = min(self.rows_parsed / self.rows_total, 1.0)
+            # Extrapolate the remaining parse time from the rate so far
+            if self.stage == 'parsing' and self.rows_parsed:
+                rate = self.rows_parsed / max(now - self.parse_started, 1e-6)
+                eta = round((self.rows_total - self.rows_parsed) / rate, 1)
+        status = {
+            'job_id': self.job_id,
+            'dataset_id': self.dataset_id,
+            'stage': self.stage,
+            'rows_parsed': self.rows_parsed,
+            'rows_total': self.rows_total,
+            'progress': progress,
+            'eta_seconds': eta,
+            'elapsed_seconds': round(now - self.created, 3),
+        }
+        if self.options is not None:
+            status.update(self.options)
+        if self.error is not None:
+            status['error'] = self.error
+        return status
+
+
+_sheet_executor = None
+_sheet_executor_users = 0
+_sheet_executor_idle = None
+_sheet_executor_lock = threading.Lock()
+
+
+@contextmanager
+def sheet_workers():
+    """Lend out the sheet worker pool, stopping it once it has sat idle a while.
+
+    Spawning the pool costs an interpreter start and app import per worker,
+    so it outlives a single parse; but idle spawned interpreters hold over
+    100 MB each, so it is not kept for good either.
+    """
+    global _sheet_executor, _sheet_executor_users, _sheet_executor_idle
+    with _sheet_executor_lock:
+        if _sheet_executor_idle is not None:
+            _sheet_executor_idle.cancel()
+            _sheet_executor_idle = None
+        if _sheet_executor is None:
+            # Spawned workers avoid forking a process that is running request threads
+            _sheet_executor = ProcessPoolExecutor(max_workers=app.config['SHEET_WORKERS'],
+                                                  mp_context=multiprocessing.get_context('spawn'))
+        _sheet_executor_users += 1
+        executor = _sheet_executor
+    try:
+        yield executor
+    finally:
+        with _sheet_executor_lock:
+            _sheet_executor_users -= 1
+            if _sheet_executor_users == 0 and _sheet_executor is executor:
+                _sheet_executor_idle = threading.Timer(app.config['SHEET_WORKERS_IDLE_SECONDS'],
+                                                       _stop_idle_sheet_workers, (executor,))
+                _sheet_executor_idle.daemon = True
+                _sheet_executor_idle.start()
+
+
+def _stop_idle_sheet_workers(executor):
+    global _sheet_executor, _sheet_executor_idle
+    with _sheet_executor_lock:
+        # A parse may have picked the pool up again since the timer started
+        if _sheet_executor is not executor or _sheet_executor_users:
+            return
+        _sheet_executor = None
+        _sheet_executor_idle = None
+    executor.shutdown(wait=True)
+
+
+def release_sheet_workers(wait=True):
+    """Stop the sheet worker processes; the pool is started again on demand."""
+    global _sheet_executor, _sheet_executor_idle
+    with _sheet_executor_lock:
+        if _sheet_executor_idle is not None:
+            _sheet_executor_idle.cancel()
+            _sheet_executor_idle = None
+        if _sheet_executor is not None:
+            _sheet_executor.shutdown(wait=wait)
+            _sheet_executor = None
+
+
+def shutdown_executors(wait=True):
+    """Stop the ingest threads and sheet worker processes, e.g. before a process exits."""
+    _shutting_down.set()
+    _claim_waiters.shutdown(wait=wait)
+    ingest_executor.shutdown(wait=wait)
+    release_sheet_workers(wait)
+
+
+def _parse_sheet(source, sheet, engine):
+    """Process-pool task: parse one sheet, or return None if it holds no price table."""
+    df = read_table(source, sheet=sheet, engine=engine)
+    if any(col not in df.columns for col in REQUIRED_COLS):
+        return None
+    return split_frame(df)
+
+
+def parse_sheets(source, sheets, job=None):
+    """Parse several sheets, one per task in the process pool, and merge them.
+
+    With SHEET_WORKERS at 1 or less the sheets are parsed one after another
+    in this process instead. Sheets without the required columns are skipped.
+    Returns (meta, values, labels, dates); the Sheet column is only added
+    when more than one sheet holds data.
+    """
+    engine = resolve_reader()
+    parts = {}
+
+    def collect(sheet, part):
+        if part is not None:
+            parts[sheet] = part
+            if job is not None:
+                job.report_rows(sum(len(meta) for meta, *_ in parts.values()))
+
+    if app.config['SHEET_WORKERS'] <= 1:
+        try:
+            for sheet in sheets:
+                collect(sheet, _parse_sheet(source, sheet, engine))
+        except Exception as e:
+            raise IngestError(f'Failed to read Excel file: {str(e)}')
+    else:
+        with sheet_workers() as executor:
+            futures = {executor.submit(_parse_sheet, source, sheet, engine): sheet for sheet in sheets}
+            try:
+                for future in as_completed(futures):
+                    collect(futures[future], future.result())
+            except Exception as e:
+                for future in futures:
+                    future.cancel()
+                raise IngestError(f'Failed to read Excel file: {str(e)}')
+
+    if not parts:
+        raise IngestError(f'No sheet has the required columns: {", ".join(REQUIRED_COLS)}')
+    ordered = [(sheet, parts[sheet]) for sheet in sheets if sheet in parts]
+    if len(ordered) == 1:
+        return ordered[0][1]
+    return merge_sheets(ordered)
+
+
+def parse_dataset(dataset_id, source, job=None, base=None):
+    """Fully parse a workbook into a Dataset and add it to the cache.
+
+    With a base dataset the workbook is a delta (new months or new rows)
+    merged into it, so the parse covers only the delta.
+    """
+    if job is not None:
+        job.set_stage('parsing')
+    try:
+        sheets = data_sheets(source)
+    except Exception as e:
+        raise IngestError(f'Failed to read Excel file: {str(e)}')
+
+    # Only several data sheets are worth the process pool; a lone one (next to
+    # notes or charts, say) is read here, and with none the first sheet's
+    # missing columns are reported
+    if len(sheets) > 1:
+        with stage_timer('read', 'ingest'):
+            parts = parse_sheets(source, sheets, job)
+    else:
+        try:
+            with stage_timer('read', 'ingest'):
+                df = read_table(source, progress=job.report_rows if job is not None else None,
+                                sheet=sheets[0] if sheets else 0)
+        except Exception as e:
+            raise IngestError(f'Failed to read {FORMAT_NAMES[detect_format(source)]} file: {str(e)}')
+
+        # Verify required columns exist
+        missing_cols = [col for col in REQUIRED_COLS if col not in df.columns]
+        if missing_cols:
+            raise IngestError(f'Missing required columns: {", ".join(missing_cols)}')
+        with stage_timer('split', 'ingest'):
+            parts = split_frame(df)
+
+    if job is not None:
+        job.report_rows(len(parts[0]))
+        job.set_stage('indexing')
+    with stage_timer('index', 'ingest'):
+        if base is not None:
+            dataset = append_dataset(dataset_id, base, parts)
+        else:
+            dataset = Dataset(dataset_id, *parts)
+    # Summary statistics for every row are computed once at ingest
+    with stage_timer('stats', 'ingest'):
+        dataset.stats
+    try:
+        with stage_timer('persist', 'ingest'):
+            save_dataset(dataset)
+            # Serve from the shared store like every other worker, and drop the private copy
+            dataset = load_stored_dataset(dataset_id) or dataset
+    except OSError as e:
+        app.logger.warning('Could not persist dataset %s: %s', dataset_id, e)
+    # Index the key combinations that have prices for the cascading filters
+    with stage_timer('filters', 'ingest'):
+        dataset.filters
+    dataset_cache.put(dataset)
+    return dataset
+
+
+def _attach_stored(job):
+    """Finish job from the dataset another worker stored, or return None if it is not there."""
+    dataset = load_stored_dataset(job.dataset_id)
+    if dataset is None:
+        return None
+    metrics.inc('resin_parses_coalesced_total')
+    dataset_cache.put(dataset)
+    job.options = options_from_meta(dataset.meta)
+    job.options['duplicate_keys'] = len(dataset.duplicate_keys)
+    job.rows_total = job.rows_parsed = len(dataset.meta)
+    job.set_stage('ready')
+    job.finished = time.time()
+    job.discovered.set()
+    return dataset
+
+
+def run_ingest(job, source, discover, base=None, claimed=False):
+    """Job body: optional metadata discovery, then the full parse (or append to base).
+
+    Jobs in one process are already deduplicated by submit_ingest; across
+    worker processes the first to claim the content hash parses it. The
+    others still run discovery, so their dropdowns arrive early, then hand
+    the job to a claim waiter and return None; the waiter finishes it.
+    """
+    handed_off = False
+    try:
+        state = 'claimed' if claimed else try_claim_parse(job.dataset_id)
+        if state == 'stored':
+            dataset = _attach_stored(job)
+            if dataset is not None:
+                return dataset
+            # Evicted as soon as it was stored; parse it here after all
+            state = try_claim_parse(job.dataset_id)
+
+        if state != 'claimed':
+            if discover:
+                discover_job(job, source)
+            job.set_stage('waiting')
+            _claim_waiters.submit(settle_job, job, wait_for_parse, job, source, base)
+            handed_off = True
+            return None
+
+        with holding_claim(job.dataset_id):
+            if discover:
+                discover_job(job, source)
+            dataset = parse_dataset(job.dataset_id, source, job, base)
+        if job.options is None:
+            job.options = options_from_meta(dataset.meta)
+        job.options['duplicate_keys'] = len(dataset.duplicate_keys)
+        job.set_stage('ready')
+        job.finished = time.time()
+        job.discovered.set()
+        return dataset
+    except IngestError as e:
+        job.fail(e.message, e.status)
+        raise
+    except Exception as e:
+        job.fail(str(e), 500)
+        raise
+    finally:
+        if not handed_off:
+            discard_upload(source)
+
+
+def discover_job(job, source):
+    """Read just the metadata columns so the job can offer dropdown options before the parse."""
+    job.set_stage('discovering')
+    with stage_timer('discover', 'ingest'):
+        meta = discover_options(source)
+    options = options_from_meta(meta)
+    if not options['locations'] or not options['grades']:
+        raise IngestError('No valid locations or grades found in the file')
+    job.rows_total = len(meta)
+    job.options = options
+    job.publish()
+    job.discovered.set()
+
+
+def wait_for_parse(job, source, base, poll=0.25):
+    """Claim-waiter body: wait out another worker's parse of the job's dataset, then attach to it.
+
+    If that worker gives up, its claim passes to this process and the job
+    goes back to the ingest pool to be parsed here.
+    """
+    handed_off = False
+    try:
+        while not _shutting_down.is_set():
+            state = try_claim_parse(job.dataset_id)
+            if state == 'claimed':
+                try:
+                    ingest_executor.submit(settle_job, job, run_ingest, job, source, False, base, True)
+                except RuntimeError:
+                    release_parse(job.dataset_id)
+                    raise
+                handed_off = True
+                return None
+            if state == 'stored':
+                dataset = _attach_stored(job)
+                if dataset is not None:
+                    return dataset
+            time.sleep(poll)
+        raise IngestError('Server is shutting down', 503)
+    except IngestError as e:
+        job.fail(e.message, e.status)
+        raise
+    except Exception as e:
+        job.fail(str(e), 500)
+        raise
+    finally:
+        if not handed_off:
+            discard_upload(source)
+
+
+def settle_job(job, body, *args):
+    """Run body for job and settle job.future with its outcome, unless body handed the job on (None)."""
+    try:
+        dataset = body(*args)
+    except BaseException as e:
+        job.future.set_exception(e)
+        return
+    if dataset is not None:
+        job.future.set_result(dataset)
+
+
+def _prune_jobs():
+    # Forget finished jobs once clients have had time to read their outcome
+    cutoff = time.time() - app.config['JOB_RETENTION_SECONDS']
+    for job_id in [job_id for job_id, job in _jobs.items() if job.finished and job.finished < cutoff]:
+        del _jobs[job_id]
+    # ... along with their markers, and those of jobs whose worker exited
+    try:
+        names = os.listdir(_job_marker_dir())
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(_job_marker_dir(), name)
+        try:
+            if os.stat(path).st_mtime >= cutoff:
+                continue
+            status = load_job_status(name[:-len('.json')]) if name.endswith('.json') else None
+            if status is None or status['stage'] in ('ready', 'failed'):
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def submit_ingest(dataset_id, source, discover=False, base=None):
+    """Start a background ingestion job, reusing one already running for the same id.
+
+    source is the workbook as bytes or as a spooled upload path; a path is
+    removed once the job no longer needs it. With a base dataset, source is
+    appended to it rather than parsed as a dataset of its own.
+    """
+    with _pending_lock:
+        job = _pending.get(dataset_id)
+        if job is not None:
+            discard_upload(source)
+        else:
+            _prune_jobs()
+            job = IngestJob(dataset_id)
+            _jobs[job.job_id] = job
+            _pending[dataset_id] = job
+            job.publish()
+            job.future = Future()
+            job.future.add_done_callback(lambda _: _pending.pop(dataset_id, None))
+            ingest_executor.submit(settle_job, job, run_ingest, job, source, discover, base)
+        return job
+
+
+def get_job(job_id):
+    with _pending_lock:
+        return _jobs.get(job_id)
+
+
+def load_job_status(job_id):
+    """Return the status another worker published for job_id, or None if there is none.
+
+    A job left unfinished by a worker that has since exited counts as gone.
+    """
+    if not job_id or not all(c in '0123456789abcdef' for c in job_id):
+        return None
+    try:
+        with open(_job_marker_path(job_id)) as f:
+            marker = json.load(f)
+    except (OSError, ValueError):
+        return None
+    status = marker['status']
+    if status['stage'] not in ('ready', 'failed') and not _pid_alive(marker['pid']):
+        return None
+    return status
+
+
+def get_dataset(dataset_id, wait=True):
+    """Return a dataset from the cache, a running background parse, or the disk store."""
+    dataset = dataset_cache.get(dataset_id)
+    if dataset is not None:
+        metrics.inc('resin_dataset_lookups_total', result='memory')
+        return dataset
+    with _pending_lock:
+        job = _pending.get(dataset_id)
+    if job is not None:
+        metrics.inc('resin_dataset_lookups_total', result='pending')
+        return job.future.result() if wait else None
+    dataset = load_stored_dataset(dataset_id)
+    if dataset is not None:
+        metrics.inc('resin_dataset_lookups_total', result='store')
+        dataset_cache.put(dataset)
+    else:
+        metrics.inc('resin_dataset_lookups_total', result='miss')
+    return dataset
+
+
+def load_dataset(stream):
+    """Return the dataset for an uploaded file stream, parsing it on a cache miss."""
+    dataset_id, path = spool_upload(stream)
+    dataset = get_dataset(dataset_id)
+    if dataset is not None:
+        discard_upload(path)
+        return dataset
+    return submit_ingest(dataset_id, path).future.result()
+
+
+def discover_options(source):
+    """Read only the Country/Location/Grade/Unit columns of a workbook.
+
+    With the streaming reader this stops each row at the last metadata
+    column, so the cost grows with the row count rather than rows x months;
+    CSV and Parquet files are column-projected by their readers.
+    Every sheet with the required columns is included, tagged with its
+    sheet name when there is more than one.
+    """
+    try:
+        # One open of the workbook for every sheet, so shared strings are loaded once
+        metas = list(read_table(source, usecols=META_COLS, sheet=None).items())
+    except Exception as e:
+        raise IngestError(f'Failed to read {FORMAT_NAMES[detect_format(source)]} file: {str(e)}')
+
+    valid = [(sheet, meta) for sheet, meta in metas if all(col in meta.columns for col in REQUIRED_COLS)]
+    if not valid:
+        missing_cols = [col for col in REQUIRED_COLS if col not in metas[0][1].columns] if metas else REQUIRED_COLS
+        raise IngestError(f'Missing required columns: {", ".join(missing_cols)}')
+    if len(valid) == 1:
+        return valid[0][1]
+    return pd.concat([meta.assign(**{SHEET_COL: sheet}) for sheet, meta in valid], ignore_index=True)
+
+
+def resolve_selections(dataset, selections):
+    """Resolve {location, grade, country, sheet} selections to unique row positions.
+
+    Returns (rows, missing) where missing lists the selections that matched
+    nothing; raises ValueError for a selection that is not an object.
+    """
+    rows = []
+    missing = []
+    seen = set()
+    for selection in selections:
+        if not isinstance(selection, dict):
+            raise ValueError('Each series selection must be an object')
+        matched = dataset.find_rows(selection.get('location'), selection.get('grade'),
+                                    selection.get('country'), selection.get('sheet'))
+        if len(matched) == 0:
+            missing.append(selection)
+        for position in matched.tolist():
+            if position not in seen:
+                seen.add(position)
+                rows.append(position)
+    return rows, missing
+
+
+def series_key(key):
+    """Return the JSON identity (country, location, grade, sheet) of a metadata record."""
+    entry = {
+        'country': key['Country'],
+        'location': key['Location'],
+        'grade': key['Grade'],
+    }
+    if SHEET_COL in key:
+        entry['sheet'] = key[SHEET_COL]
+    return entry
+
+
+def options_from_meta(meta):
+    """Return the sorted unique locations and grades (and sheets) of a metadata block."""
+    options = {
+        'locations': sorted(meta['Location'].dropna().unique().tolist()),
+        'grades': sorted(meta['Grade'].dropna().unique().tolist()),
+        'rows': len(meta),
+    }
+    if SHEET_COL in meta.columns:
+        options['sheets'] = meta[SHEET_COL].unique().tolist()
+    return options
+
+
+def series_response(dataset, location, grade, country, sheet, params, fmt='json'):
+    """Build the chart response for one series, with range, resample, overlay and max_points params.
+
+    fmt is the negotiated response format, see negotiate_format.
+    """
+    # Look up the row for the selected location and grade in the index
+    with stage_timer('lookup'):
+        position = dataset.lookup(location, grade, country, sheet)
+
+    if position is None:
+        return jsonify({'error': f'No data found for Location: {location}, Grade: {grade}'}), 400
+
+    try:
+        bounds, freq = parse_range(params)
+        max_points = parse_max_points(params)
+        overlays, window = parse_overlays(params)
+        dtype = parse_dtype(params)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Duplicate keys resolve to the first matching row; empty and zero cells are masked out.
+    # A date range is a binary-searched column slice of the sorted axis.
+    with stage_timer('slice'):
+        columns = dataset.column_slice(**bounds)
+        labels, dates, values = dataset.series(position, columns)
+        if freq:
+            labels, dates, values = resample_series(dates, values, freq)
+
+    if len(labels) == 0:
+        return jsonify({'error': 'No valid price data found for this location and grade'}), 400
+
+    # Rolling overlays come from the dataset-wide cache; a resampled series needs its own
+    with stage_timer('overlays'):
+        if freq and overlays:
+            rolling = compute_rolling(values[None, :], dates, window, overlays)
+            overlay_values = {name: rolling[name][0] for name in overlays}
+        else:
+            overlay_values = dataset.row_overlays(position, columns, overlays, window)
+
+    # Whole-history stats are precomputed; a range or resample needs its own
+    with stage_timer('stats'):
+        if columns == slice(None) and not freq:
+            stats = dataset.row_stats(position)
+        else:
+            stats = _json_records(compute_stats(values[None, :], dates))[0]
+
+    # Stats cover every point; only the plotted series is downsampled
+    total_points = len(values)
+    with stage_timer('downsample'):
+        keep = downsample_indices(dates, values, max_points)
+        if keep is not None:
+            labels, dates, values = labels[keep], dates[keep], values[keep]
+            overlay_values = {name: overlay[keep] for name, overlay in overlay_values.items()}
+
+    with stage_timer('serialize'):
+        result = series_arrays(labels, dates, values, overlay_values, fmt, dtype)
+        result.update({
+            'stats': stats,
+            'total_points': total_points,
+            'downsampled': len(values) < total_points
+        })
+        if overlays:
+            result['window'] = window
+        return series_output(result, fmt)
+
+
+def parse_dtype(params):
+    """Read the dtype of binary series values, raising ValueError if invalid."""
+    dtype = params.get('dtype') or 'float64'
+    if dtype not in SERIES_DTYPES:
+        raise ValueError(f'Invalid dtype {dtype}, choose one of: {", ".join(SERIES_DTYPES)}')
+    return dtype
+
+
+def negotiate_format():
+    """Pick 'json', 'raw' or 'arrow' from the request's Accept header, JSON unless asked otherwise."""
+    offers = [JSON_MIMETYPE, RAW_SERIES_MIMETYPE]
+    if _has_pyarrow():
+        offers.append(ARROW_MIMETYPE)
+    best = request.accept_mimetypes.best_match(offers, default=JSON_MIMETYPE)
+    return {RAW_SERIES_MIMETYPE: 'raw', ARROW_MIMETYPE: 'arrow'}.get(best, 'json')
+
+
+def epoch_days(dates):
+    """datetime64 dates as int64 days since the epoch; undated columns become the int64 minimum."""
+    return dates.astype('datetime64[D]').astype(np.int64)
+
+
+def series_arrays(labels, dates, values, overlay_values, fmt, dtype='float64'):
+    """The dates, values and overlays of one series as lists for JSON, or typed arrays for binary."""
+    if fmt == 'json':
+        entry = {'dates': labels.tolist(), 'values': values.tolist()}
+        if overlay_values:
+            entry['overlays'] = {name: _json_values(overlay) for name, overlay in overlay_values.items()}
+    else:
+        entry = {'dates': epoch_days(dates), 'values': values.astype(dtype, copy=False)}
+        if overlay_values:
+            entry['overlays'] = {name: overlay.astype(dtype, copy=False) for name, overlay in overlay_values.items()}
+    return entry
+
+
+def encode_raw(result):
+    """Encode a result holding numpy arrays as a JSON header plus little-endian buffers.
+
+    Layout: RAW_SERIES_MAGIC, the header length as uint32, the header padded
+    to 8 bytes, then each buffer padded to 8 bytes. Arrays in the header are
+    replaced by {"$buffer": i}; header['buffers'][i] gives the dtype, the
+    offset from the start of the buffers and the element count, so clients
+    can view each one as a typed array without copying.
+    """
+    buffers = []
+    specs = []
+    offset = 0
+
+    def walk(node):
+        nonlocal offset
+        if isinstance(node, np.ndarray):
+            array = np.ascontiguousarray(node, dtype=node.dtype.newbyteorder('<'))
+            specs.append({'dtype': array.dtype.name, 'offset': offset, 'length': len(array)})
+            buffers.append(array.tobytes())
+            offset += -(-array.nbytes // 8) * 8
+            return {'$buffer': len(specs) - 1}
+        if isinstance(node, dict):
+            return {key: walk(value) for key, value in node.items()}
+        if isinstance(node, list):
+            return [walk(value) for value in node]
+        return node
+
+    header = json.dumps({'result': walk(result), 'buffers': specs}, separators=(',', ':')).encode()
+    header += b' ' * (-len(header) % 8)
+    parts = [RAW_SERIES_MAGIC, len(header).to_bytes(4, 'little'), header]
+    for data in buffers:
+        parts.append(data)
+        parts.append(b'\0' * (-len(data) % 8))
+    return b''.join(parts)
+
+
+def encode_arrow(result):
+    """Encode a result as an Arrow IPC stream holding one row per point.
+
+    Columns are date (date32), value and one per overlay, plus the position
+    in result['series'] for batches. Everything else in the result goes into
+    the schema metadata under 'resin' as JSON.
+    """
+    import pyarrow as pa
+
+    entries = result['series'] if 'series' in result else [result]
+    columns = {'series': [], 'date': [], 'value': []}
+    overlay_names = list(entries[0].get('overlays', {})) if entries else []
+    for name in overlay_names:
+        columns[name] = []
+    for i, entry in enumerate(entries):
+        columns['series'].append(np.full(len(entry['values']), i, dtype=np.int32))
+        columns['date'].append(entry['dates'].astype('datetime64[D]'))
+        columns['value'].append(entry['values'])
+        for name in overlay_names:
+            columns[name].append(entry['overlays'][name])
+    if 'series' not in result:
+        del columns['series']
+    arrays = {name: np.concatenate(parts) if parts else np.array([]) for name, parts in columns.items()}
+    if not entries:
+        arrays['date'] = arrays['date'].astype('datetime64[D]')
+    table = pa.table({name: pa.array(array, from_pandas=True) for name, array in arrays.items()})
+
+    def strip(entry):
+        return {key: value for key, value in entry.items() if key not in ('dates', 'values', 'overlays')}
+
+    meta = strip(result)
+    if 'series' in result:
+        meta['series'] = [strip(entry) for entry in entries]
+    table = table.replace_schema_metadata({'resin': json.dumps(meta)})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def series_output(result, fmt):
+    """Serialize a series result in the negotiated format."""
+    if fmt == 'raw':
+        return Response(encode_raw(result), mimetype=RAW_SERIES_MIMETYPE)
+    if fmt == 'arrow':
+        return Response(encode_arrow(result), mimetype=ARROW_MIMETYPE)
+    return jsonify(result)
+
+
+def series_etag(dataset_id, params, fmt='json'):
+    """Strong ETag for a series request.
+
+    Datasets are immutable and named by the hash of their contents, so the
+    id, the query parameters and the response format fully determine the
+    response body.
+    """
+    query = urlencode(sorted(params.items(multi=True)))
+    digest = hashlib.sha256(f'{SERIES_ETAG_VERSION}\0{dataset_id}\0{fmt}\0{query}'.encode()).hexdigest()
+    return f'{dataset_id[:16]}-{digest[:16]}'
+
+
+def matched_etag(etag):
+    """Return the variant of etag (plain or compressed) that If-None-Match names, or None."""
+    for variant in (etag, f'{etag}-gzip', f'{etag}-br'):
+        if request.if_none_match.contains(variant):
+            return variant
+    return None
+
 
 # HTML Template with Upload Form and Chart Display
 HTML_TEMPLATE = """
@@ -409,15 +3007,15 @@ HTML_TEMPLATE = """
             <div class="upload-area" id="uploadArea">
                 <div class="upload-icon">📁</div>
                 <div class="upload-text">Click to upload or drag and drop</div>
-                <div class="upload-hint">Excel files (.xlsx, .xls) - Your data should have Country, Location, Grade columns</div>
-                <input type="file" id="fileInput" accept=".xlsx,.xls">
+                <div class="upload-hint">Excel (.xlsx, .xls), CSV or Parquet files - Your data should have Country, Location, Grade columns</div>
+                <input type="file" id="fileInput" accept=".xlsx,.xls,.csv,.parquet">
             </div>
             
             <div class="file-info" id="fileInfo"></div>
             
             <div class="loading" id="loading">
                 <div class="spinner"></div>
-                <div>Processing your file...</div>
+                <div id="loadingText">Processing your file...</div>
             </div>
             
             <div class="error" id="error"></div>
@@ -426,7 +3024,7 @@ HTML_TEMPLATE = """
             <div class="instructions">
                 <h3>📋 Instructions:</h3>
                 <ul>
-                    <li>Upload an Excel file with Country, Location, and Grade columns</li>
+                    <li>Upload an Excel, CSV or Parquet file with Country, Location, and Grade columns</li>
                     <li>Date columns should follow the format (e.g., 1/1/2022, 2/1/2022, etc.)</li>
                     <li>Value columns should contain numeric price data</li>
                     <li>After upload, select Location and Grade to view the price trend</li>
@@ -450,6 +3048,45 @@ HTML_TEMPLATE = """
                         <option value="">-- Select Grade --</option>
                     </select>
                 </div>
+                
+                <div class="filter-group" id="sheetGroup" style="display: none;">
+                    <label for="sheetSelect">🗂️ Sheet</label>
+                    <select id="sheetSelect">
+                        <option value="">-- Select Sheet --</option>
+                    </select>
+                </div>
+                
+                <div class="filter-group">
+                    <label for="rangeSelect">📅 Range</label>
+                    <select id="rangeSelect">
+                        <option value="">Full history</option>
+                        <option value="12">Last 12 months</option>
+                        <option value="36">Last 3 years</option>
+                        <option value="60">Last 5 years</option>
+                    </select>
+                </div>
+                
+                <div class="filter-group">
+                    <label for="freqSelect">⏱️ Frequency</label>
+                    <select id="freqSelect">
+                        <option value="">As uploaded</option>
+                        <option value="M">Monthly average</option>
+                        <option value="Q">Quarterly average</option>
+                        <option value="Y">Yearly average</option>
+                    </select>
+                </div>
+                
+                <div class="filter-group">
+                    <label for="overlaySelect">📐 Overlay</label>
+                    <select id="overlaySelect">
+                        <option value="">None</option>
+                        <option value="ma:3">3-period moving average</option>
+                        <option value="ma:12">12-period moving average</option>
+                        <option value="volatility_pct:6">6-period volatility (%)</option>
+                        <option value="mom_pct">Month-over-month change (%)</option>
+                        <option value="yoy_pct">Year-over-year change (%)</option>
+                    </select>
+                </div>
             </div>
             
             <button class="btn" onclick="generateChart()">📈 Generate Chart</button>
@@ -489,6 +3126,18 @@ HTML_TEMPLATE = """
                     <div class="stat-label">Data Points</div>
                     <div class="stat-value" id="dataPoints">-</div>
                 </div>
+                <div class="stat-card">
+                    <div class="stat-label">Std Deviation</div>
+                    <div class="stat-value" id="stddev">-<span class="stat-unit">Rs/Kg</span></div>
+                </div>
+                <div class="stat-card">
+                    <div class="stat-label">CAGR</div>
+                    <div class="stat-value" id="cagr">-<span class="stat-unit">%</span></div>
+                </div>
+                <div class="stat-card">
+                    <div class="stat-label">Max Drawdown</div>
+                    <div class="stat-value" id="drawdown">-<span class="stat-unit">%</span></div>
+                </div>
             </div>
             
             <button class="btn" onclick="location.reload()" style="margin-top: 20px;">
@@ -500,10 +3149,21 @@ HTML_TEMPLATE = """
     <script>
         let uploadedFile = null;
         let availableData = null;
+        let datasetId = null;
+        let filterRequest = 0;
+        let currentChart = null;
+        
+        // Server-side LTTB keeps plotted series at about one point per pixel
+        const MAX_POINTS = 1000;
+        const SERIES_MIMETYPE = 'application/x-resin-series';
+        const TYPED_ARRAYS = {float64: Float64Array, float32: Float32Array, int64: BigInt64Array};
+        const INT64_MIN = -(2n ** 63n);
+        const CHUNKED_UPLOAD_BYTES = 8 * 1024 * 1024;
         
         const uploadArea = document.getElementById('uploadArea');
         const fileInput = document.getElementById('fileInput');
         const loading = document.getElementById('loading');
+        const loadingText = document.getElementById('loadingText');
         const error = document.getElementById('error');
         const success = document.getElementById('success');
         const fileInfo = document.getElementById('fileInfo');
@@ -511,6 +3171,18 @@ HTML_TEMPLATE = """
         const chartSection = document.getElementById('chartSection');
         const locationSelect = document.getElementById('locationSelect');
         const gradeSelect = document.getElementById('gradeSelect');
+        const sheetGroup = document.getElementById('sheetGroup');
+        const sheetSelect = document.getElementById('sheetSelect');
+        const rangeSelect = document.getElementById('rangeSelect');
+        const freqSelect = document.getElementById('freqSelect');
+        const overlaySelect = document.getElementById('overlaySelect');
+        
+        const OVERLAY_NAMES = {
+            ma: 'Moving average',
+            volatility_pct: 'Volatility',
+            mom_pct: 'MoM change',
+            yoy_pct: 'YoY change'
+        };
         
         // Click to upload
         uploadArea.addEventListener('click', () => fileInput.click());
@@ -542,6 +3214,8 @@ HTML_TEMPLATE = """
         
         function handleFile(file) {
             uploadedFile = file;
+            datasetId = null;
+            availableData = null;
             hideMessages();
             chartSection.classList.remove('active');
             
@@ -560,50 +3234,201 @@ HTML_TEMPLATE = """
             // Upload and get available options
             loading.classList.add('active');
             
+            // Large files go up in resumable chunks instead of one request
+            const upload = file.size > CHUNKED_UPLOAD_BYTES ? chunkedUpload(file) : simpleUpload(file);
+            
+            upload
+            .then(data => {
+                if (data.error) {
+                    loading.classList.remove('active');
+                    showError(data.error);
+                    return;
+                }
+                
+                datasetId = data.dataset_id;
+                handleJobStatus(data, file);
+            })
+            .catch(err => {
+                loading.classList.remove('active');
+                showError('Failed to upload file: ' + err.message);
+            });
+        }
+        
+        function simpleUpload(file) {
             const formData = new FormData();
             formData.append('file', file);
             
-            fetch('/upload', {
+            return fetch('/upload', {
                 method: 'POST',
                 body: formData
             })
+            .then(response => response.json());
+        }
+        
+        function chunkedUpload(file) {
+            return fetch('/uploads', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({filename: file.name, size: file.size})
+            })
             .then(response => response.json())
-            .then(data => {
-                loading.classList.remove('active');
-                
-                if (data.error) {
-                    showError(data.error);
-                    return;
+            .then(session => {
+                if (session.error) {
+                    return session;
                 }
-                
-                availableData = data;
-                populateFilters(data.locations, data.grades);
+                return sendChunks(session, file, 0, 0);
+            });
+        }
+        
+        function sendChunks(session, file, offset, retries) {
+            if (offset >= file.size) {
+                return fetch(session.complete_url, {method: 'POST'}).then(response => response.json());
+            }
+            
+            loadingText.textContent = `Uploading ${Math.round(offset / file.size * 100)}%...`;
+            return fetch(session.upload_url, {
+                method: 'PUT',
+                headers: {'Upload-Offset': String(offset), 'Content-Type': 'application/octet-stream'},
+                body: file.slice(offset, offset + session.chunk_size)
+            })
+            .then(response => response.json().then(data => ({status: response.status, data: data})))
+            .then(result => {
+                // 409 means the server holds a different offset; carry on from there
+                if (result.status === 200 || result.status === 409) {
+                    return sendChunks(session, file, result.data.offset, 0);
+                }
+                return result.data;
+            })
+            .catch(err => {
+                if (retries >= 3) {
+                    throw err;
+                }
+                // Resume from whatever the server has after a dropped connection
+                return fetch(session.upload_url)
+                    .then(response => response.json())
+                    .then(status => sendChunks(session, file, status.offset, retries + 1));
+            });
+        }
+        
+        function handleJobStatus(job, file) {
+            // Ignore updates for a file that has since been replaced
+            if (file !== uploadedFile) {
+                return;
+            }
+            
+            if (job.error) {
+                loading.classList.remove('active');
+                loadingText.textContent = 'Processing your file...';
+                showError(job.error);
+                return;
+            }
+            
+            if (job.locations && !availableData) {
+                loading.classList.remove('active');
+                availableData = job;
+                populateFilters(job.locations, job.grades, job.sheets || []);
                 filterSection.classList.add('active');
                 filterSection.scrollIntoView({ behavior: 'smooth' });
-                success.textContent = `File uploaded successfully! Found ${data.locations.length} locations and ${data.grades.length} grades.`;
+            }
+            
+            if (availableData) {
+                let message = `File uploaded successfully! Found ${availableData.locations.length} locations and ${availableData.grades.length} grades.`;
+                if (job.stage && job.stage !== 'ready') {
+                    message += ` Loading prices${formatProgress(job)}...`;
+                }
+                success.textContent = message;
                 success.classList.add('active');
+            } else {
+                loadingText.textContent = `Reading your file${formatProgress(job)}...`;
+            }
+            
+            if (job.status_url && job.stage !== 'ready') {
+                setTimeout(() => pollJob(job.status_url, file), 500);
+            }
+        }
+        
+        function pollJob(statusUrl, file) {
+            fetch(statusUrl)
+            .then(response => response.json())
+            .then(job => {
+                job.status_url = statusUrl;
+                handleJobStatus(job, file);
             })
             .catch(err => {
                 loading.classList.remove('active');
-                showError('Failed to upload file: ' + err.message);
+                showError('Failed to check upload progress: ' + err.message);
             });
         }
         
-        function populateFilters(locations, grades) {
-            locationSelect.innerHTML = '<option value="">-- Select Location --</option>';
-            gradeSelect.innerHTML = '<option value="">-- Select Grade --</option>';
-            
-            locations.forEach(location => {
-                const option = new Option(location, location);
-                locationSelect.add(option);
+        function formatProgress(job) {
+            if (job.progress === null || job.progress === undefined) {
+                return '';
+            }
+            let text = ` ${Math.round(job.progress * 100)}%`;
+            if (job.eta_seconds !== null && job.eta_seconds !== undefined) {
+                text += ` (about ${Math.ceil(job.eta_seconds)}s left)`;
+            }
+            return text;
+        }
+        
+        function populateFilters(locations, grades, sheets) {
+            // Multi-sheet workbooks add a Sheet filter
+            sheetGroup.style.display = sheets.length > 1 ? 'block' : 'none';
+            setOptions(sheetSelect, '-- Select Sheet --', sheets);
+            setOptions(locationSelect, '-- Select Location --', locations);
+            setOptions(gradeSelect, '-- Select Grade --', grades);
+        }
+        
+        function setOptions(select, placeholder, values) {
+            // Keep the current choice if it is still offered
+            const current = select.value;
+            select.innerHTML = `<option value="">${placeholder}</option>`;
+            values.forEach(value => {
+                select.add(new Option(value, value));
             });
-            
-            grades.forEach(grade => {
-                const option = new Option(grade, grade);
-                gradeSelect.add(option);
+            select.value = values.includes(current) ? current : '';
+            return select.value === current;
+        }
+        
+        function narrowFilters() {
+            // Offer only combinations that have prices, so every choice can be charted
+            if (!datasetId) {
+                return;
+            }
+            const params = new URLSearchParams({dataset_id: datasetId});
+            if (locationSelect.value) {
+                params.append('location', locationSelect.value);
+            }
+            if (gradeSelect.value) {
+                params.append('grade', gradeSelect.value);
+            }
+            if (sheetSelect.value) {
+                params.append('sheet', sheetSelect.value);
+            }
+            const requestNumber = ++filterRequest;
+            fetch('/options?' + params.toString())
+            .then(response => response.json())
+            .then(data => {
+                // A later change has already asked again
+                if (data.error || requestNumber !== filterRequest) {
+                    return;
+                }
+                let kept = setOptions(locationSelect, '-- Select Location --', data.locations);
+                kept = setOptions(gradeSelect, '-- Select Grade --', data.grades) && kept;
+                if (data.sheets) {
+                    kept = setOptions(sheetSelect, '-- Select Sheet --', data.sheets) && kept;
+                }
+                // A dropped choice no longer narrows the others
+                if (!kept) {
+                    narrowFilters();
+                }
             });
         }
         
+        locationSelect.addEventListener('change', narrowFilters);
+        gradeSelect.addEventListener('change', narrowFilters);
+        sheetSelect.addEventListener('change', narrowFilters);
+        
         function generateChart() {
             const location = locationSelect.value;
             const grade = gradeSelect.value;
@@ -613,6 +3438,11 @@ HTML_TEMPLATE = """
                 return;
             }
             
+            if (sheetGroup.style.display !== 'none' && !sheetSelect.value) {
+                showError('Please select a Sheet');
+                return;
+            }
+            
             if (!uploadedFile) {
                 showError('Please upload a file first');
                 return;
@@ -621,16 +3451,7 @@ HTML_TEMPLATE = """
             hideMessages();
             loading.classList.add('active');
             
-            const formData = new FormData();
-            formData.append('file', uploadedFile);
-            formData.append('location', location);
-            formData.append('grade', grade);
-            
-            fetch('/generate', {
-                method: 'POST',
-                body: formData
-            })
-            .then(response => response.json())
+            requestChart(location, grade, true)
             .then(data => {
                 loading.classList.remove('active');
                 
@@ -639,6 +3460,7 @@ HTML_TEMPLATE = """
                     return;
                 }
                 
+                currentChart = {location: location, grade: grade, downsampled: data.downsampled};
                 displayChart(data, location, grade);
                 chartSection.classList.add('active');
                 chartSection.scrollIntoView({ behavior: 'smooth' });
@@ -649,10 +3471,100 @@ HTML_TEMPLATE = """
             });
         }
         
+        function requestChart(location, grade, useDataset, range) {
+            // Fetch by dataset id with a cacheable GET; re-send the file if the server evicted it
+            const params = new URLSearchParams();
+            params.append('location', location);
+            params.append('grade', grade);
+            if (sheetSelect.value) {
+                params.append('sheet', sheetSelect.value);
+            }
+            if (range) {
+                params.append('start', range.start);
+                params.append('end', range.end);
+            } else if (rangeSelect.value) {
+                params.append('months', rangeSelect.value);
+            }
+            if (freqSelect.value) {
+                params.append('freq', freqSelect.value);
+            }
+            if (overlaySelect.value) {
+                const [overlay, size] = overlaySelect.value.split(':');
+                params.append('overlays', overlay);
+                if (size) {
+                    params.append('window', size);
+                }
+            }
+            params.append('max_points', MAX_POINTS);
+            
+            if (useDataset && datasetId) {
+                params.append('dataset_id', datasetId);
+                return fetch('/series?' + params.toString(), {
+                    headers: {Accept: `${SERIES_MIMETYPE}, application/json;q=0.9`}
+                })
+                .then(response => {
+                    if (response.status === 404) {
+                        return requestChart(location, grade, false, range);
+                    }
+                    if ((response.headers.get('Content-Type') || '').startsWith(SERIES_MIMETYPE)) {
+                        return response.arrayBuffer().then(decodeSeries);
+                    }
+                    return response.json();
+                });
+            }
+            
+            const formData = new FormData();
+            formData.append('file', uploadedFile);
+            params.forEach((value, key) => formData.append(key, value));
+            return fetch('/generate', {
+                method: 'POST',
+                body: formData
+            })
+            .then(response => response.json());
+        }
+        
+        function decodeSeries(buffer) {
+            // Raw series format: magic, uint32 header length, JSON header, then
+            // 8-byte aligned little-endian buffers viewed in place as typed arrays
+            const view = new DataView(buffer);
+            const headerLength = view.getUint32(4, true);
+            const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 8, headerLength)));
+            const start = 8 + headerLength;
+            const arrays = header.buffers.map(spec => {
+                const Type = TYPED_ARRAYS[spec.dtype];
+                return new Type(buffer, start + spec.offset, spec.length);
+            });
+            const resolve = node => {
+                if (Array.isArray(node)) {
+                    return node.map(resolve);
+                }
+                if (node && typeof node === 'object') {
+                    if ('$buffer' in node) {
+                        return arrays[node.$buffer];
+                    }
+                    const out = {};
+                    for (const key in node) {
+                        out[key] = resolve(node[key]);
+                    }
+                    return out;
+                }
+                return node;
+            };
+            const data = resolve(header.result);
+            // Dates arrive as int64 epoch days; Plotly takes epoch milliseconds on a date axis
+            data.dates = Float64Array.from(data.dates, day => day === INT64_MIN ? NaN : Number(day) * 86400000);
+            return data;
+        }
+        
+        function dateLabel(value) {
+            return typeof value === 'number' ? new Date(value).toISOString().slice(0, 10) : value;
+        }
+        
         function displayChart(data, location, grade) {
             // Update chart title
-            document.getElementById('chartTitle').textContent = `${location} - ${grade}`;
-            document.getElementById('chartSubtitle').textContent = `Price trend from ${data.dates[0]} to ${data.dates[data.dates.length - 1]}`;
+            const sheetLabel = sheetSelect.value ? ` (${sheetSelect.value})` : '';
+            document.getElementById('chartTitle').textContent = `${location} - ${grade}${sheetLabel}`;
+            document.getElementById('chartSubtitle').textContent = `Price trend from ${dateLabel(data.dates[0])} to ${dateLabel(data.dates[data.dates.length - 1])}`;
             
             const trace = {
                 x: data.dates,
@@ -677,13 +3589,24 @@ HTML_TEMPLATE = """
                 fillcolor: 'rgba(102, 126, 234, 0.1)'
             };
             
-            const minVal = Math.min(...data.values);
-            const maxVal = Math.max(...data.values);
+            // Rolling analytics are computed server-side; percentages get their own axis
+            const traces = [trace];
+            const overlay = overlayTrace(data);
+            if (overlay) {
+                traces.push(overlay);
+            }
+            
+            // Peak and lowest come from the server-side stats engine; spreading
+            // long series into Math.min/Math.max overflows the call stack
+            const stats = data.stats;
+            const minVal = stats.lowest;
+            const maxVal = stats.peak;
             const padding = (maxVal - minVal) * 0.1;
             
             const layout = {
                 xaxis: {
                     title: 'Date',
+                    type: 'date',
                     showgrid: true,
                     gridcolor: '#f0f0f0',
                     tickangle: -45
@@ -695,6 +3618,8 @@ HTML_TEMPLATE = """
                     range: [Math.max(0, minVal - padding), maxVal + padding],
                     tickformat: ',.0f'
                 },
+                showlegend: traces.length > 1,
+                legend: {orientation: 'h', y: 1.1},
                 plot_bgcolor: 'white',
                 paper_bgcolor: 'white',
                 hovermode: 'closest',
@@ -706,6 +3631,16 @@ HTML_TEMPLATE = """
                 }
             };
             
+            if (overlay && overlay.yaxis === 'y2') {
+                layout.yaxis2 = {
+                    title: '%',
+                    overlaying: 'y',
+                    side: 'right',
+                    showgrid: false
+                };
+                layout.margin.r = 60;
+            }
+            
             const config = {
                 responsive: true,
                 displayModeBar: true,
@@ -713,22 +3648,26 @@ HTML_TEMPLATE = """
                 modeBarButtonsToRemove: ['lasso2d', 'select2d']
             };
             
-            Plotly.newPlot('chart', [trace], layout, config);
+            Plotly.newPlot('chart', traces, layout, config).then(chart => {
+                chart.removeAllListeners('plotly_relayout');
+                chart.on('plotly_relayout', onChartZoom);
+            });
             
             // Update statistics
-            const values = data.values;
-            const latest = values[values.length - 1];
-            const first = values[0];
-            const peak = Math.max(...values);
-            const lowest = Math.min(...values);
-            const avg = values.reduce((a, b) => a + b, 0) / values.length;
-            const change = ((latest - first) / first * 100);
+            const latest = stats.latest;
+            const peak = stats.peak;
+            const lowest = stats.lowest;
+            const avg = stats.average;
+            const change = stats.change_pct;
             
             document.getElementById('latest').innerHTML = `₹${latest.toLocaleString()}<span class="stat-unit">Rs/Kg</span>`;
             document.getElementById('peak').innerHTML = `₹${peak.toLocaleString()}<span class="stat-unit">Rs/Kg</span>`;
             document.getElementById('lowest').innerHTML = `₹${lowest.toLocaleString()}<span class="stat-unit">Rs/Kg</span>`;
             document.getElementById('average').innerHTML = `₹${avg.toLocaleString('en-IN', {maximumFractionDigits: 0})}<span class="stat-unit">Rs/Kg</span>`;
-            document.getElementById('dataPoints').textContent = values.length;
+            document.getElementById('dataPoints').textContent = stats.points;
+            document.getElementById('stddev').innerHTML = `₹${stats.stddev.toLocaleString('en-IN', {maximumFractionDigits: 0})}<span class="stat-unit">Rs/Kg</span>`;
+            document.getElementById('cagr').innerHTML = `${stats.cagr_pct === null ? '-' : stats.cagr_pct.toFixed(2)}<span class="stat-unit">%</span>`;
+            document.getElementById('drawdown').innerHTML = `${stats.max_drawdown_pct.toFixed(2)}<span class="stat-unit">%</span>`;
             
             const changeEl = document.getElementById('change');
             const changeText = Math.abs(change).toFixed(2);
@@ -736,6 +3675,54 @@ HTML_TEMPLATE = """
             changeEl.style.color = change >= 0 ? '#27ae60' : '#e74c3c';
         }
         
+        function overlayTrace(data) {
+            if (!data.overlays) {
+                return null;
+            }
+            const name = Object.keys(data.overlays)[0];
+            const percent = name !== 'ma';
+            return {
+                x: data.dates,
+                y: data.overlays[name],
+                type: 'scatter',
+                mode: 'lines',
+                name: name === 'ma' ? `${data.window}-period moving average` : OVERLAY_NAMES[name],
+                yaxis: percent ? 'y2' : 'y',
+                connectgaps: false,
+                line: {
+                    color: '#e67e22',
+                    width: 2,
+                    dash: percent ? 'dot' : 'solid'
+                },
+                hovertemplate: percent ? '<b>%{x}</b><br>%{y:.2f}%<extra></extra>' : '<b>%{x}</b><br>MA: ₹%{y:,.0f}/Kg<extra></extra>'
+            };
+        }
+        
+        function onChartZoom(event) {
+            // Only a downsampled series has more detail to fetch for the zoomed window
+            if (!currentChart || !currentChart.downsampled) {
+                return;
+            }
+            
+            let range = null;
+            if (event['xaxis.range[0]'] !== undefined) {
+                range = {start: event['xaxis.range[0]'], end: event['xaxis.range[1]']};
+            } else if (!event['xaxis.autorange']) {
+                return;
+            }
+            
+            requestChart(currentChart.location, currentChart.grade, true, range)
+            .then(data => {
+                if (!data.error) {
+                    Plotly.restyle('chart', {x: [data.dates], y: [data.values]}, [0]);
+                    const overlay = overlayTrace(data);
+                    if (overlay) {
+                        Plotly.restyle('chart', {x: [overlay.x], y: [overlay.y]}, [1]);
+                    }
+                }
+            });
+        }
+        
         function showError(message) {
             error.textContent = '❌ ' + message;
             error.classList.add('active');
@@ -750,6 +3737,62 @@ HTML_TEMPLATE = """
 </html>
 """
 
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    metrics.start_flushing()
+
+@app.after_request
+def record_request_timing(response):
+    """Report the request's stage timings in Server-Timing and record them on /metrics."""
+    start = g.get('request_start')
+    if start is None:
+        return response
+    total = time.perf_counter() - start
+    metrics.observe('resin_request_seconds', total, endpoint=request.endpoint or 'unknown',
+                    status=str(response.status_code))
+    timings = [f'{stage};dur={seconds * 1000:.2f}' for stage, seconds in g.get('stage_timings', [])]
+    timings.append(f'total;dur={total * 1000:.2f}')
+    response.headers['Server-Timing'] = ', '.join(timings)
+    return response
+
+@app.after_request
+def compress_response(response):
+    """Encode large JSON and text bodies with brotli or gzip, whichever the client prefers.
+
+    Registered after the timing hook so that it runs first and its time is
+    part of the request total. A compressed response gets its own ETag.
+    """
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES or response.direct_passthrough:
+        return response
+    response.vary.add('Accept-Encoding')
+    if (response.status_code != 200 or 'Content-Encoding' in response.headers
+            or response.content_length is None or response.content_length < app.config['COMPRESS_MIN_BYTES']):
+        return response
+    brotli = _brotli()
+    if brotli is not None and request.accept_encodings['br']:
+        encoding = 'br'
+    elif request.accept_encodings['gzip']:
+        encoding = 'gzip'
+    else:
+        return response
+    
+    with stage_timer('compress'):
+        data = response.get_data()
+        if encoding == 'br':
+            # Brotli quality runs 0-11 against gzip's 1-9
+            body = brotli.compress(data, quality=min(app.config['COMPRESS_LEVEL'], 11))
+        else:
+            body = gzip.compress(data, compresslevel=app.config['COMPRESS_LEVEL'], mtime=0)
+    metrics.inc('resin_compressed_bytes_total', len(data), encoding=encoding, stage='before')
+    metrics.inc('resin_compressed_bytes_total', len(body), encoding=encoding, stage='after')
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f'{etag}-{encoding}', weak)
+    return response
+
 @app.route('/')
 def index():
     return render_template_string(HTML_TEMPLATE)
@@ -764,110 +3807,564 @@ def upload_file():
         if file.filename == '':
             return jsonify({'error': 'No file selected'}), 400
         
-        # Read the file
-        file_bytes = file.read()
-        
-        # Try to read as Excel
+        # Spool the file to disk while hashing it; repeat uploads hit the cache
         try:
-            df = pd.read_excel(io.BytesIO(file_bytes))
-        except Exception as e:
-            return jsonify({'error': f'Failed to read Excel file: {str(e)}'}), 400
+            with stage_timer('spool'):
+                dataset_id, path = spool_upload(file.stream)
+        except IngestError as e:
+            return jsonify({'error': e.message}), e.status
+        return start_ingest_response(dataset_id, path)
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def start_ingest_response(dataset_id, path):
+    """Answer an upload: options for a known dataset, otherwise a job to poll.
+
+    append_to=<dataset_id> merges the upload into that dataset as new months
+    or rows instead; the merged dataset gets an id of its own.
+    """
+    try:
+        base = None
+        base_id = request.values.get('append_to')
+        if base_id:
+            try:
+                base = get_dataset(base_id)
+            except IngestError as e:
+                discard_upload(path)
+                return jsonify({'error': e.message}), e.status
+            if base is None:
+                discard_upload(path)
+                return jsonify({'error': 'Dataset to append to not found or expired, please upload it again'}), 404
+            dataset_id = append_id(base_id, dataset_id)
         
-        # Verify required columns exist
-        required_cols = ['Country', 'Location', 'Grade']
-        missing_cols = [col for col in required_cols if col not in df.columns]
-        if missing_cols:
-            return jsonify({'error': f'Missing required columns: {", ".join(missing_cols)}'}), 400
+        with stage_timer('lookup'):
+            dataset = get_dataset(dataset_id, wait=False)
         
-        # Get unique locations and grades
-        locations = sorted(df['Location'].dropna().unique().tolist())
-        grades = sorted(df['Grade'].dropna().unique().tolist())
+        if dataset is not None:
+            discard_upload(path)
+            with stage_timer('serialize'):
+                options = options_from_meta(dataset.meta)
+                return jsonify({
+                    'dataset_id': dataset_id,
+                    'status': 'ready',
+                    **options,
+                    'duplicate_keys': len(dataset.duplicate_keys)
+                })
         
-        if not locations or not grades:
-            return jsonify({'error': 'No valid locations or grades found in the file'}), 400
+        # Discovery and the full parse run as a background job; the client
+        # polls /jobs/<job_id>, or passes wait=1 to block until discovery.
+        # An append parses only the delta, so it skips discovery.
+        job = submit_ingest(dataset_id, path, discover=base is None, base=base)
+        if request.values.get('wait'):
+            with stage_timer('discover'):
+                job.discovered.wait()
+            if job.error is not None:
+                return jsonify({'error': job.error}), job.error_status
         
-        return jsonify({
-            'locations': locations,
-            'grades': grades,
-            'rows': len(df)
-        })
+        status = job.to_dict()
+        # The dataset id lets any worker answer once the job's own worker has stored it
+        status['status_url'] = f'/jobs/{job.job_id}?dataset_id={dataset_id}'
+        return jsonify(status), 200 if job.options is not None else 202
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    payload = request.get_json(silent=True) or {}
+    size = payload.get('size')
+    if size is not None and (not isinstance(size, int) or size < 0):
+        return jsonify({'error': 'size must be a non-negative number of bytes'}), 400
+    if size is not None and size > app.config['MAX_UPLOAD_BYTES']:
+        return jsonify({'error': 'File is too large'}), 413
+    session = create_upload_session(payload.get('filename'), size)
+    return jsonify(session.to_dict()), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    session = get_upload_session(upload_id)
+    if session is None:
+        return jsonify({'error': 'Upload not found or expired'}), 404
+    return jsonify(session.to_dict())
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    try:
+        session = get_upload_session(upload_id)
+        if session is None:
+            return jsonify({'error': 'Upload not found or expired'}), 404
+        
+        try:
+            offset = int(request.headers.get('Upload-Offset', ''))
+        except ValueError:
+            return jsonify({'error': 'Upload-Offset header is required'}), 400
+        
+        # A chunk for the wrong offset gets the current one back so the client can resume
+        try:
+            appended = session.append(request.stream, offset)
+        except IngestError as e:
+            return jsonify({'error': e.message}), e.status
+        except HTTPException as e:
+            # e.g. a chunk over MAX_CONTENT_LENGTH (413) or a dropped connection (400)
+            return jsonify({'error': e.description}), e.code
+        if not appended:
+            status = session.to_dict()
+            status['error'] = f'Expected a chunk at offset {status["offset"]}'
+            return jsonify(status), 409
+        return jsonify(session.to_dict())
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    session = get_upload_session(upload_id)
+    try:
+        completed = session.complete() if session is not None else None
+    except IngestError as e:
+        return jsonify({'error': e.message}), e.status
+    if completed is None:
+        return jsonify({'error': 'Upload not found or expired'}), 404
+    
+    # Chunks may have reached different workers, so the file is hashed once here and parsed once
+    return start_ingest_response(*completed)
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        # The job may have run in another worker: its result is in the shared
+        # store and its progress (or failure) in the job marker it published
+        status = load_job_status(job_id)
+        dataset_id = request.args.get('dataset_id') or (status or {}).get('dataset_id')
+        dataset = get_dataset(dataset_id, wait=False) if dataset_id else None
+        if dataset is None:
+            if status is None or status['stage'] == 'ready':
+                return jsonify({'error': 'Job not found or expired'}), 404
+            return jsonify(status)
+        return jsonify({
+            'job_id': job_id,
+            'dataset_id': dataset_id,
+            'stage': 'ready',
+            'progress': 1.0,
+            'eta_seconds': None,
+            **options_from_meta(dataset.meta),
+            'duplicate_keys': len(dataset.duplicate_keys)
+        })
+    return jsonify(job.to_dict())
+
 @app.route('/generate', methods=['POST'])
 def generate_chart():
     try:
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file provided'}), 400
-        
-        file = request.files['file']
+        dataset_id = request.form.get('dataset_id')
         location = request.form.get('location')
         grade = request.form.get('grade')
+        country = request.form.get('country')
+        sheet = request.form.get('sheet')
         
         if not location or not grade:
             return jsonify({'error': 'Location and Grade are required'}), 400
         
-        # Read the file
-        file_bytes = file.read()
+        # Prefer the dataset parsed by /upload; fall back to a posted file
+        if dataset_id:
+            try:
+                with stage_timer('load'):
+                    dataset = get_dataset(dataset_id)
+            except IngestError as e:
+                return jsonify({'error': e.message}), e.status
+            if dataset is None:
+                return jsonify({'error': 'Dataset not found or expired, please upload the file again'}), 404
+        elif 'file' in request.files:
+            try:
+                with stage_timer('load'):
+                    dataset = load_dataset(request.files['file'].stream)
+            except IngestError as e:
+                return jsonify({'error': e.message}), e.status
+        else:
+            return jsonify({'error': 'No file provided'}), 400
+        
+        return series_response(dataset, location, grade, country, sheet, request.form, negotiate_format())
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/series', methods=['GET'])
+def get_series():
+    """Cacheable /generate: the same parameters in the query string of a stored dataset."""
+    try:
+        dataset_id = request.args.get('dataset_id')
+        location = request.args.get('location')
+        grade = request.args.get('grade')
+        
+        if not dataset_id:
+            return jsonify({'error': 'dataset_id is required'}), 400
+        if not location or not grade:
+            return jsonify({'error': 'Location and Grade are required'}), 400
+        
+        # Answer revalidations without touching the dataset at all
+        fmt = negotiate_format()
+        etag = series_etag(dataset_id, request.args, fmt)
+        cache_control = f'public, max-age={app.config["SERIES_MAX_AGE"]}'
+        matched = matched_etag(etag)
+        if matched:
+            metrics.inc('resin_not_modified_total', endpoint='get_series')
+            response = app.response_class(status=304)
+            response.set_etag(matched)
+            response.headers['Cache-Control'] = cache_control
+            response.vary.add('Accept')
+            return response
         
         try:
-            df = pd.read_excel(io.BytesIO(file_bytes))
-        except Exception as e:
-            return jsonify({'error': f'Failed to read Excel file: {str(e)}'}), 400
+            with stage_timer('load'):
+                dataset = get_dataset(dataset_id)
+        except IngestError as e:
+            return jsonify({'error': e.message}), e.status
+        if dataset is None:
+            return jsonify({'error': 'Dataset not found or expired, please upload the file again'}), 404
         
-        # Filter data for the selected location and grade
-        filtered_df = df[(df['Location'] == location) & (df['Grade'] == grade)]
+        response = make_response(series_response(dataset, location, grade, request.args.get('country'),
+                                                 request.args.get('sheet'), request.args, fmt))
+        if response.status_code == 200:
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = cache_control
+        response.vary.add('Accept')
+        return response
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/series/batch', methods=['POST'])
+def batch_series():
+    try:
+        payload = request.get_json(silent=True) or {}
+        dataset_id = payload.get('dataset_id')
+        selections = payload.get('series')
         
-        if filtered_df.empty:
-            return jsonify({'error': f'No data found for Location: {location}, Grade: {grade}'}), 400
+        if not dataset_id:
+            return jsonify({'error': 'dataset_id is required'}), 400
+        if not isinstance(selections, list) or not selections:
+            return jsonify({'error': 'series must be a non-empty list of {location, grade} selections'}), 400
+        try:
+            bounds, freq = parse_range({key: payload.get(key) for key in ('start', 'end', 'months', 'freq')})
+            max_points = parse_max_points(payload)
+            overlays, window = parse_overlays(payload)
+            dtype = parse_dtype(payload)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        fmt = negotiate_format()
         
-        # Get the row (should be only one row after filtering)
-        row = filtered_df.iloc[0]
+        try:
+            dataset = get_dataset(dataset_id)
+        except IngestError as e:
+            return jsonify({'error': e.message}), e.status
+        if dataset is None:
+            return jsonify({'error': 'Dataset not found or expired, please upload the file again'}), 404
         
-        # Extract date columns (skip Country, Location, Grade, Unit columns and any other non-numeric columns)
-        skip_cols = ['Country', 'Location', 'Grade', 'Unit']
+        # Resolve every selection (wildcards included) to row positions first
+        try:
+            rows, missing = resolve_selections(dataset, selections)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        # Extract dates and values
-        dates = []
-        values = []
+        if len(rows) > app.config['MAX_BATCH_SERIES']:
+            return jsonify({'error': f'Selection matches {len(rows)} series, the limit is {app.config["MAX_BATCH_SERIES"]}'}), 400
         
-        for col in df.columns:
-            if col in skip_cols:
-                continue
-            
-            value = row[col]
-            
-            # Skip if value is 0, NaN, empty, or not numeric
-            try:
-                numeric_value = float(value)
-                if numeric_value != 0 and pd.notna(numeric_value):
-                    dates.append(str(col))
-                    values.append(numeric_value)
-            except (ValueError, TypeError):
-                # Skip non-numeric columns
+        # Extract all matched series from a single slice of the value matrix
+        columns = dataset.column_slice(**bounds)
+        keys = dataset.meta.iloc[rows].to_dict('records')
+        # Overlays for every row come from one rolling pass, cached or over just
+        # these rows; resampled series need their own, as in series_response
+        overlay_block = dataset.block_overlays(rows, columns, [] if freq else overlays, window)
+        series = []
+        for key, (labels, dates, values), overlay_values in zip(keys, dataset.series_block(rows, columns), overlay_block):
+            if len(labels) == 0:
+                missing.append({k.lower(): v for k, v in key.items() if k != 'Unit'})
                 continue
+            if freq:
+                labels, dates, values = resample_series(dates, values, freq)
+                if overlays:
+                    rolling = compute_rolling(values[None, :], dates, window, overlays)
+                    overlay_values = {name: rolling[name][0] for name in overlays}
+            keep = downsample_indices(dates, values, max_points)
+            if keep is not None:
+                labels, dates, values = labels[keep], dates[keep], values[keep]
+                overlay_values = {name: overlay[keep] for name, overlay in overlay_values.items()}
+            entry = series_key(key)
+            entry.update(series_arrays(labels, dates, values, overlay_values, fmt, dtype))
+            series.append(entry)
+        
+        result = {
+            'dataset_id': dataset_id,
+            'series': series,
+            'missing': missing
+        }
+        if overlays:
+            result['window'] = window
+        return series_output(result, fmt)
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/series/correlation', methods=['POST'])
+def series_correlation():
+    try:
+        payload = request.get_json(silent=True) or {}
+        dataset_id = payload.get('dataset_id')
+        selections = payload.get('series')
+        basis = payload.get('basis', 'returns')
+        
+        if not dataset_id:
+            return jsonify({'error': 'dataset_id is required'}), 400
+        if not isinstance(selections, list) or not selections:
+            return jsonify({'error': 'series must be a non-empty list of {location, grade} selections'}), 400
+        if basis not in ('returns', 'levels'):
+            return jsonify({'error': 'basis must be returns or levels'}), 400
+        try:
+            bounds, _ = parse_range({key: payload.get(key) for key in ('start', 'end', 'months')})
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        try:
+            dataset = get_dataset(dataset_id)
+        except IngestError as e:
+            return jsonify({'error': e.message}), e.status
+        if dataset is None:
+            return jsonify({'error': 'Dataset not found or expired, please upload the file again'}), 404
+        
+        try:
+            rows, missing = resolve_selections(dataset, selections)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if len(rows) < 2:
+            return jsonify({'error': 'Select at least two series to compare'}), 400
+        if len(rows) > app.config['MAX_CORRELATION_SERIES']:
+            return jsonify({'error': f'Selection matches {len(rows)} series, the limit is {app.config["MAX_CORRELATION_SERIES"]}'}), 400
+        
+        # Every pair is computed in one pass over the aligned block and cached per selection
+        columns = dataset.column_slice(**bounds)
+        result = dataset.correlation(rows, columns, basis)
+        
+        def matrix(values):
+            return [_json_values(row) for row in values]
+        
+        response = {
+            'dataset_id': dataset_id,
+            'basis': basis,
+            'series': [series_key(key) for key in dataset.meta.iloc[rows].to_dict('records')],
+            'missing': missing,
+            'correlation': matrix(result['correlation']),
+            'observations': result['observations'].tolist(),
+            'spread_mean': matrix(result['spread_mean']),
+            'spread_latest': matrix(result['spread_latest'])
+        }
+        
+        # Full spread series for the upper triangle of pairs, on the shared date axis
+        if payload.get('spreads'):
+            block = dataset.values[rows, columns]
+            first, second = np.triu_indices(len(rows), k=1)
+            spreads = block[first] - block[second]
+            response['dates'] = dataset.labels[columns].tolist()
+            response['spreads'] = [
+                {'a': int(i), 'b': int(j), 'values': _json_values(values)}
+                for i, j, values in zip(first, second, spreads)
+            ]
+        
+        return jsonify(response)
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    # Liveness: the process is up and answering requests
+    return jsonify({'status': 'ok', 'pid': os.getpid()})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    # Readiness: the process still takes ingest jobs. Preloading finishes before
+    # workers start, and ingest works without the store, which is only reported.
+    store_dir = app.config['DATASET_STORE_DIR']
+    store_ok = os.access(store_dir if os.path.isdir(store_dir) else os.path.dirname(store_dir) or '.', os.W_OK)
+    ready = not _shutting_down.is_set()
+    cache_bytes, datasets = dataset_cache.usage()
+    return jsonify({
+        'status': 'ready' if ready else 'not ready',
+        'pid': os.getpid(),
+        'preloaded': list(preloaded_datasets),
+        'store_writable': store_ok,
+        'cached_datasets': len(datasets),
+        'cache_bytes': cache_bytes
+    }), 200 if ready else 503
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    cache_bytes, datasets = dataset_cache.usage()
+    with _pending_lock:
+        running = len(_pending)
+    gauges = [
+        ('resin_dataset_cache_bytes', {}, cache_bytes),
+        ('resin_dataset_cache_max_bytes', {}, dataset_cache.max_bytes),
+        ('resin_dataset_cache_items', {}, len(datasets)),
+        ('resin_ingest_jobs', {}, running),
+    ]
+    gauges.extend(('resin_dataset_bytes', {'dataset_id': dataset_id}, nbytes) for dataset_id, nbytes in datasets)
+    stored = stored_datasets()
+    gauges.append(('resin_store_bytes', {}, sum(size for _, size, _, _ in stored)))
+    gauges.append(('resin_store_max_bytes', {}, app.config['DATASET_STORE_MAX_BYTES']))
+    gauges.extend(('resin_store_references', {'dataset_id': dataset_id}, refs) for dataset_id, _, refs, _ in stored)
+    return app.response_class(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+@app.route('/stats', methods=['GET'])
+def series_stats():
+    try:
+        dataset_id = request.args.get('dataset_id')
+        sort = request.args.get('sort')
+        order = request.args.get('order', 'desc')
+        limit = request.args.get('limit', type=int)
+        
+        if not dataset_id:
+            return jsonify({'error': 'dataset_id is required'}), 400
+        
+        try:
+            dataset = get_dataset(dataset_id)
+        except IngestError as e:
+            return jsonify({'error': e.message}), e.status
+        if dataset is None:
+            return jsonify({'error': 'Dataset not found or expired, please upload the file again'}), 404
+        
+        # Statistics for every row were computed in one pass at ingest
+        stats = dataset.stats
+        if sort and sort not in stats.columns:
+            return jsonify({'error': f'Cannot sort by {sort}, choose one of: {", ".join(stats.columns)}'}), 400
         
-        if not dates or not values:
-            return jsonify({'error': 'No valid price data found for this location and grade'}), 400
+        rows = dataset.find_rows(request.args.get('location'), request.args.get('grade'),
+                                 request.args.get('country'), request.args.get('sheet'))
+        table = pd.concat([dataset.meta.iloc[rows].rename(columns=str.lower), stats.iloc[rows]], axis=1)
+        table = table[table['points'] > 0]
+        if sort:
+            table = table.sort_values(sort, ascending=(order == 'asc'), na_position='last')
+        if limit is not None:
+            table = table.head(limit)
         
         return jsonify({
-            'dates': dates,
-            'values': values
+            'dataset_id': dataset_id,
+            'stats': _json_records(table)
         })
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/options', methods=['GET'])
+def filter_options():
+    """Dropdown options narrowed by the current selections, e.g. the grades sold at a location."""
+    try:
+        dataset_id = request.args.get('dataset_id')
+        if not dataset_id:
+            return jsonify({'error': 'dataset_id is required'}), 400
+        
+        try:
+            dataset = get_dataset(dataset_id)
+        except IngestError as e:
+            return jsonify({'error': e.message}), e.status
+        if dataset is None:
+            return jsonify({'error': 'Dataset not found or expired, please upload the file again'}), 404
+        
+        selected = {
+            'Country': request.args.get('country'),
+            'Location': request.args.get('location'),
+            'Grade': request.args.get('grade'),
+            SHEET_COL: request.args.get('sheet'),
+        }
+        with stage_timer('options'):
+            options = dataset.filters.options(selected)
+        return jsonify({'dataset_id': dataset_id, **options})
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+preloaded_datasets = []
+
+
+def preload_datasets(sources):
+    """Parse workbooks (paths) or load stored datasets (ids) into the cache.
+
+    Run in the server process before workers fork: the parsed matrices,
+    precomputed stats and filter index are then shared copy-on-write by
+    every worker.
+    """
+    try:
+        for source in sources:
+            if os.path.isfile(source):
+                hasher = hashlib.sha256()
+                with open(source, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                        hasher.update(chunk)
+                dataset_id = hasher.hexdigest()
+                dataset = get_dataset(dataset_id) or parse_dataset(dataset_id, source)
+            else:
+                dataset = get_dataset(source)
+                if dataset is None:
+                    app.logger.warning('Cannot preload %s: not a file or a stored dataset id', source)
+                    continue
+                # Stored matrices are memory-mapped, so workers already share their pages
+                dataset.stats
+            dataset.filters
+            preloaded_datasets.append(dataset.dataset_id)
+            print(f"   Preloaded {source} as {dataset.dataset_id} ({len(dataset.meta)} rows)")
+    finally:
+        # Forked workers must not inherit a process pool with its management thread
+        release_sheet_workers()
+    # Keep preloaded objects out of the collector so it never dirties their pages
+    gc.freeze()
+
+
+def serve(host, port, workers, threads):
+    """Serve the app with gunicorn (workers x threads), or a threaded server without it."""
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        print("⚠️  gunicorn is not installed, serving from one process with threads")
+        app.run(host=host, port=port, threaded=True)
+        return
+
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'{host}:{port}')
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('timeout', app.config['WORKER_TIMEOUT'])
+            # The app (and any preloaded datasets) is loaded once in the master
+            self.cfg.set('preload_app', True)
+
+        def load(self):
+            return app
+
+    # Workers pool their counters and histograms so any of them can answer /metrics
+    metrics.share(os.path.join(app.config['METRICS_DIR'], str(port)))
+    Server().run()
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Resin Price Tracker web application')
+    parser.add_argument('--dev', action='store_true', help='run the Flask development server with the debugger')
+    parser.add_argument('--host', default=app.config['HOST'])
+    parser.add_argument('--port', type=int, default=app.config['PORT'])
+    parser.add_argument('--workers', type=int, default=app.config['WORKERS'])
+    parser.add_argument('--threads', type=int, default=app.config['THREADS'])
+    parser.add_argument('--preload', action='append', default=list(app.config['PRELOAD_DATASETS']),
+                        help='workbook path or stored dataset id to load before serving (repeatable)')
+    args = parser.parse_args()
+    
     print("=" * 70)
     print("🚀 Resin Price Tracker - Web Application")
     print("=" * 70)
     print("\n✅ Server starting...")
     print("\n📍 Open your browser and go to:")
-    print("   http://localhost:5000")
+    print(f"   http://localhost:{args.port}")
     print("\n📱 To access from other devices on your network:")
-    print("   http://YOUR_LOCAL_IP:5000")
+    print(f"   http://YOUR_LOCAL_IP:{args.port}")
     print("\n💡 Features:")
     print("   • Upload Excel files with resin price data")
     print("   • Filter by Location and Grade")
@@ -877,4 +4374,11 @@ if __name__ == '__main__':
     print("=" * 70)
     print()
     
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    if args.dev:
+        app.run(host=args.host, port=args.port, debug=True)
+    else:
+        if args.preload:
+            print("📦 Preloading datasets...")
+            preload_datasets(args.preload)
+        print(f"🧵 {args.workers} worker(s) x {args.threads} thread(s)")
+        serve(args.host, args.port, args.workers, args.threads)
\ No newline at end of file
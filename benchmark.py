@@ -0,0 +1,469 @@
+"""
+Resin Price Tracker - Benchmarks
+================================
+Compares the Excel reader engines available to app.py on a real workbook,
+the Excel, CSV and Parquet ingest paths on identical data, and measures the
+whole app end to end on synthetic workbooks. The claims command checks the
+cross-process parse claims instead, exiting non-zero if any check fails.
+
+Usage:
+    python benchmark.py readers prices.xlsx [--repeat 3] [--json results.json]
+    python benchmark.py formats prices.xlsx [--repeat 3] [--json results.json]
+    python benchmark.py generate out.xlsx [--rows 1000] [--columns 120] [--sparsity 0.1] [--sheets 1]
+    python benchmark.py e2e [--rows 1000] [--columns 120] [--sparsity 0.1] [--sheets 1]
+                            [--uploads 3] [--charts 200] [--json results.json] [--baseline old.json]
+    python benchmark.py claims [--racers 4] [--rounds 3]
+
+Each engine, format or end-to-end run happens in a fresh process so its peak
+RSS is measured on its own.
+"""
+
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def _peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def _run_reader(path, engine, repeat, results):
+    import app
+
+    with open(path, 'rb') as f:
+        file_bytes = f.read()
+    baseline_rss = _peak_rss_mb()
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        df = app.read_excel(file_bytes, engine=engine)
+        timings.append(time.perf_counter() - start)
+
+    results.put({
+        'engine': engine,
+        'rows': len(df),
+        'columns': len(df.columns),
+        'median_s': statistics.median(timings),
+        'min_s': min(timings),
+        'peak_rss_mb': _peak_rss_mb(),
+        'parse_rss_mb': _peak_rss_mb() - baseline_rss,
+    })
+
+
+def bench_readers(path, repeat):
+    import app
+
+    context = multiprocessing.get_context('spawn')
+    rows = []
+    for engine in app.available_readers():
+        results = context.Queue()
+        process = context.Process(target=_run_reader, args=(path, engine, repeat, results))
+        process.start()
+        rows.append(results.get())
+        process.join()
+    return rows
+
+
+def _run_format(path, label, repeat, results):
+    import app
+
+    baseline_rss = _peak_rss_mb()
+    timings = []
+    for _ in range(repeat):
+        # Full ingest: read the file and split it into metadata + value matrix
+        start = time.perf_counter()
+        df = app.read_table(path)
+        app.split_frame(df)
+        timings.append(time.perf_counter() - start)
+
+    results.put({
+        'engine': label,
+        'rows': len(df),
+        'columns': len(df.columns),
+        'bytes': os.path.getsize(path),
+        'median_s': statistics.median(timings),
+        'min_s': min(timings),
+        'peak_rss_mb': _peak_rss_mb(),
+        'parse_rss_mb': _peak_rss_mb() - baseline_rss,
+    })
+
+
+def bench_formats(path, repeat):
+    """Convert a workbook to CSV and Parquet and time each ingest path."""
+    import app
+
+    df = app.read_excel(path)
+    # Text formats need string headers; dates are written the way Excel shows them
+    df.columns = [col if isinstance(col, str) else f'{col.month}/{col.day}/{col.year}'
+                  if hasattr(col, 'month') else str(col) for col in df.columns]
+
+    context = multiprocessing.get_context('spawn')
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        files = [('excel', path)]
+        csv_path = os.path.join(tmp, 'data.csv')
+        df.to_csv(csv_path, index=False)
+        files.append(('csv', csv_path))
+        if app._has_pyarrow():
+            parquet_path = os.path.join(tmp, 'data.parquet')
+            df.to_parquet(parquet_path, index=False)
+            files.append(('parquet', parquet_path))
+        else:
+            print('pyarrow is not installed, skipping Parquet')
+
+        for label, file_path in files:
+            results = context.Queue()
+            process = context.Process(target=_run_format, args=(file_path, label, repeat, results))
+            process.start()
+            rows.append(results.get())
+            process.join()
+    return rows
+
+
+def generate_workbook(path, rows=1000, columns=120, sparsity=0.1, sheets=1, seed=0):
+    """Write a synthetic price workbook shaped like the real uploads.
+
+    Every sheet has `rows` Country/Location/Grade/Unit rows (ten grades per
+    location) and `columns` monthly date columns; a `sparsity` fraction of
+    the price cells is left empty.
+    """
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    months = pd.date_range('2000-01-01', periods=columns, freq='MS')
+    with pd.ExcelWriter(path, engine='openpyxl') as writer:
+        for sheet in range(sheets):
+            locations = [f'City{i // 10}' for i in range(rows)]
+            grades = [f'G{i % 10}' for i in range(rows)]
+            # Random walks so the series look like prices rather than noise
+            steps = rng.normal(0, 2, size=(rows, columns))
+            prices = np.round(np.clip(100 + np.cumsum(steps, axis=1), 1, None), 1)
+            prices[rng.random((rows, columns)) < sparsity] = np.nan
+            frame = pd.DataFrame(prices, columns=[month.to_pydatetime() for month in months])
+            frame.insert(0, 'Country', 'India')
+            frame.insert(1, 'Location', locations)
+            frame.insert(2, 'Grade', grades)
+            frame.insert(3, 'Unit', 'Rs/Kg')
+            frame.to_excel(writer, sheet_name=f'Prices{sheet + 1}', index=False)
+
+
+def _summarise(timings):
+    ordered = sorted(timings)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+    return {
+        'count': len(ordered),
+        'mean_s': statistics.mean(ordered),
+        'p50_s': percentile(50),
+        'p90_s': percentile(90),
+        'p99_s': percentile(99),
+        'max_s': ordered[-1],
+    }
+
+
+def _run_e2e(path, uploads, charts, seed, results):
+    store = tempfile.mkdtemp(prefix='resin-bench-')
+    # The store location is read when app is imported
+    os.environ['DATASET_STORE_DIR'] = store
+    import app
+
+    # Synthetic workbooks can be larger than the interactive upload limit
+    app.app.config['MAX_CONTENT_LENGTH'] = None
+    client = app.app.test_client()
+    with open(path, 'rb') as f:
+        file_bytes = f.read()
+    baseline_rss = _peak_rss_mb()
+
+    timings = {'upload': [], 'discovery': [], 'ingest': []}
+    try:
+        for _ in range(uploads):
+            # Start cold every time: drop the in-memory cache and the stored copy
+            app.dataset_cache = app.DatasetCache(app.app.config['DATASET_CACHE_MAX_BYTES'])
+            for name in os.listdir(store):
+                shutil.rmtree(os.path.join(store, name), ignore_errors=True)
+
+            start = time.perf_counter()
+            response = client.post('/upload', data={'file': (io.BytesIO(file_bytes), os.path.basename(path))})
+            timings['upload'].append(time.perf_counter() - start)
+            status = response.get_json()
+            if 'error' in status:
+                raise RuntimeError(status['error'])
+
+            # Follow the job directly rather than polling, so timings are not rounded to the poll interval
+            job = app.get_job(status['job_id'])
+            job.discovered.wait()
+            timings['discovery'].append(time.perf_counter() - start)
+            job.future.result()
+            timings['ingest'].append(time.perf_counter() - start)
+
+        dataset_id = status['dataset_id']
+        dataset = app.get_dataset(dataset_id)
+        keys = dataset.meta[['Location', 'Grade']].drop_duplicates().to_numpy().tolist()
+        rng = random.Random(seed)
+        chart_timings = []
+        chart_start = time.perf_counter()
+        for _ in range(charts):
+            location, grade = rng.choice(keys)
+            start = time.perf_counter()
+            response = client.post('/generate', data={
+                'dataset_id': dataset_id,
+                'location': location,
+                'grade': grade,
+                'sheet': dataset.sheets[0] if dataset.sheets else '',
+                'max_points': 1000,
+            })
+            chart_timings.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                raise RuntimeError(response.get_json().get('error'))
+        chart_elapsed = time.perf_counter() - chart_start
+    finally:
+        # Worker processes would otherwise keep this process from exiting
+        app.shutdown_executors()
+        shutil.rmtree(store, ignore_errors=True)
+
+    summary = {stage: _summarise(values) for stage, values in timings.items()}
+    summary['generate'] = _summarise(chart_timings)
+    summary['generate']['throughput_rps'] = charts / chart_elapsed
+    summary['ingest']['throughput_mb_s'] = len(file_bytes) / (1024 * 1024) / summary['ingest']['mean_s']
+    results.put({
+        'stages': summary,
+        'file_mb': len(file_bytes) / (1024 * 1024),
+        'rows': len(dataset.meta),
+        'peak_rss_mb': _peak_rss_mb(),
+        'run_rss_mb': _peak_rss_mb() - baseline_rss,
+    })
+
+
+def bench_e2e(args):
+    """Generate a workbook and drive upload, discovery and charts through the test client."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'synthetic.xlsx')
+        generate_workbook(path, args.rows, args.columns, args.sparsity, args.sheets, args.seed)
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        process = context.Process(target=_run_e2e, args=(path, args.uploads, args.charts, args.seed, results))
+        process.start()
+        result = results.get()
+        process.join()
+
+    result['config'] = {
+        'rows': args.rows,
+        'columns': args.columns,
+        'sparsity': args.sparsity,
+        'sheets': args.sheets,
+        'uploads': args.uploads,
+        'charts': args.charts,
+        'seed': args.seed,
+    }
+    return result
+
+
+def _race_claim(store, dataset_id, timeout, barrier, done, results):
+    os.environ['DATASET_STORE_DIR'] = store
+    import app
+
+    app.app.config['PARSE_CLAIM_TIMEOUT_SECONDS'] = timeout
+    barrier.wait()
+    state = app.try_claim_parse(dataset_id)
+    results.put(state)
+    if state == 'claimed':
+        # Stay alive with the claim until every racer has tried
+        done.wait()
+        app.release_parse(dataset_id)
+
+
+def _spawn_owner(seconds):
+    """Start a process to stand in for another worker holding a claim."""
+    return subprocess.Popen([sys.executable, '-c', f'import time; time.sleep({seconds})'])
+
+
+def check_claims(args):
+    """Exercise try_claim_parse, holding_claim and release_parse across real processes.
+
+    Returns [(check, passed, detail)]. Covers claims left by a dead owner or
+    not refreshed in time, several processes racing to take over one stale
+    claim, release leaving a successor's claim alone and the heartbeat.
+    """
+    with tempfile.TemporaryDirectory() as store:
+        os.environ['DATASET_STORE_DIR'] = store
+        import app
+
+        app.app.config['DATASET_STORE_DIR'] = store
+        app.app.config['PARSE_CLAIM_TIMEOUT_SECONDS'] = 60
+        checks = []
+        dataset_id = 'c1' * 32
+        path = app._claim_path(dataset_id)
+
+        def claim_as(pid, age=0):
+            with open(path, 'w') as f:
+                f.write(f'{pid} other')
+            os.utime(path, (time.time() - age, time.time() - age))
+
+        def owned():
+            with open(path) as f:
+                return f.read().startswith(f'{os.getpid()} ')
+
+        dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+        dead.wait()
+        claim_as(dead.pid)
+        state = app.try_claim_parse(dataset_id)
+        checks.append(('dead owner is taken over', state == 'claimed' and owned(), state))
+        app.release_parse(dataset_id)
+        checks.append(('release removes own claim', not os.path.exists(path), ''))
+
+        owner = _spawn_owner(120)
+        try:
+            claim_as(owner.pid)
+            state = app.try_claim_parse(dataset_id)
+            checks.append(('fresh claim of a live owner is kept', state == 'busy', state))
+            claim_as(owner.pid, age=61)
+            state = app.try_claim_parse(dataset_id)
+            checks.append(('expired claim is taken over', state == 'claimed' and owned(), state))
+            # Someone else took it over from us in turn; our release must leave theirs
+            claim_as(owner.pid)
+            app.release_parse(dataset_id)
+            checks.append(('release keeps a successor\'s claim', os.path.exists(path), ''))
+            os.remove(path)
+
+            app.app.config['PARSE_CLAIM_TIMEOUT_SECONDS'] = 2
+            app.try_claim_parse(dataset_id)
+            with app.holding_claim(dataset_id):
+                os.utime(path, (time.time() - 100, time.time() - 100))
+                time.sleep(1.5)
+                age = time.time() - os.stat(path).st_mtime
+            checks.append(('heartbeat refreshes the claim', age < 2, f'{age:.1f}s old'))
+            checks.append(('holding_claim releases on exit', not os.path.exists(path), ''))
+
+            context = multiprocessing.get_context('spawn')
+            for stale, described in (('dead', 'a dead owner\'s claim'), ('expired', 'an expired claim')):
+                outcomes = []
+                for _ in range(args.rounds):
+                    if stale == 'dead':
+                        claim_as(dead.pid)
+                    else:
+                        claim_as(owner.pid, age=61)
+                    barrier = context.Barrier(args.racers)
+                    done = context.Event()
+                    results = context.Queue()
+                    racers = [context.Process(target=_race_claim, args=(store, dataset_id, 60, barrier, done, results))
+                              for _ in range(args.racers)]
+                    for process in racers:
+                        process.start()
+                    states = sorted(results.get() for _ in racers)
+                    done.set()
+                    for process in racers:
+                        process.join()
+                    outcomes.append(states.count('claimed'))
+                checks.append((f'{args.racers} racers take over {described} once', outcomes == [1] * args.rounds,
+                               f'claimed per round: {outcomes}'))
+        finally:
+            owner.kill()
+            owner.wait()
+            app.shutdown_executors()
+    return checks
+
+
+def print_e2e(result, baseline=None):
+    print(f"{result['rows']} rows, {result['config']['columns']} date columns, "
+          f"{result['config']['sheets']} sheet(s), {result['file_mb']:.1f} MB")
+    print(f"{'stage':<12}{'count':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'vs baseline':>14}")
+    for stage, row in result['stages'].items():
+        change = ''
+        if baseline and stage in baseline.get('stages', {}):
+            before = baseline['stages'][stage]['p50_s']
+            change = f"{(row['p50_s'] - before) / before * 100:+.1f}%"
+        print(f"{stage:<12}{row['count']:>7}{row['p50_s'] * 1000:>10.1f}{row['p90_s'] * 1000:>10.1f}"
+              f"{row['p99_s'] * 1000:>10.1f}{change:>14}")
+    print(f"chart throughput {result['stages']['generate']['throughput_rps']:.1f} req/s, "
+          f"ingest {result['stages']['ingest']['throughput_mb_s']:.2f} MB/s, "
+          f"peak RSS {result['peak_rss_mb']:.1f} MB")
+
+
+def print_table(rows):
+    print(f"{'engine':<20}{'rows':>8}{'median s':>12}{'min s':>10}{'peak RSS MB':>14}{'parse RSS MB':>14}")
+    for row in rows:
+        print(f"{row['engine']:<20}{row['rows']:>8}{row['median_s']:>12.3f}{row['min_s']:>10.3f}"
+              f"{row['peak_rss_mb']:>14.1f}{row['parse_rss_mb']:>14.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Resin Price Tracker benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    readers = subparsers.add_parser('readers', help='compare Excel reader engines on one workbook')
+    readers.add_argument('path')
+    readers.add_argument('--repeat', type=int, default=3)
+    readers.add_argument('--json', help='also write the results to this file')
+
+    formats = subparsers.add_parser('formats', help='compare Excel, CSV and Parquet ingest on the same data')
+    formats.add_argument('path', help='workbook to convert to the other formats')
+    formats.add_argument('--repeat', type=int, default=3)
+    formats.add_argument('--json', help='also write the results to this file')
+
+    def add_workbook_shape(command):
+        command.add_argument('--rows', type=int, default=1000, help='price rows per sheet')
+        command.add_argument('--columns', type=int, default=120, help='monthly date columns')
+        command.add_argument('--sparsity', type=float, default=0.1, help='fraction of empty price cells')
+        command.add_argument('--sheets', type=int, default=1)
+        command.add_argument('--seed', type=int, default=0)
+
+    generate = subparsers.add_parser('generate', help='write a synthetic workbook')
+    generate.add_argument('path')
+    add_workbook_shape(generate)
+
+    e2e = subparsers.add_parser('e2e', help='time upload, discovery and chart requests through the app')
+    add_workbook_shape(e2e)
+    e2e.add_argument('--uploads', type=int, default=3, help='cold uploads of the workbook')
+    e2e.add_argument('--charts', type=int, default=200, help='chart requests for random series')
+    e2e.add_argument('--json', help='also write the results to this file')
+    e2e.add_argument('--baseline', help='earlier --json results to compare against')
+
+    claims = subparsers.add_parser('claims', help='check the cross-process parse claims')
+    claims.add_argument('--racers', type=int, default=4, help='processes racing for one stale claim')
+    claims.add_argument('--rounds', type=int, default=3)
+
+    args = parser.parse_args()
+    if args.command == 'claims':
+        checks = check_claims(args)
+        for check, passed, detail in checks:
+            print(f"{'ok' if passed else 'FAIL':<6}{check}{f'  ({detail})' if detail else ''}")
+        sys.exit(0 if all(passed for _, passed, _ in checks) else 1)
+    if args.command == 'generate':
+        generate_workbook(args.path, args.rows, args.columns, args.sparsity, args.sheets, args.seed)
+        return
+    if args.command == 'e2e':
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        rows = bench_e2e(args)
+        print_e2e(rows, baseline)
+    else:
+        if args.command == 'readers':
+            rows = bench_readers(args.path, args.repeat)
+        else:
+            rows = bench_formats(args.path, args.repeat)
+        print_table(rows)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()